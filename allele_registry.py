@@ -0,0 +1,111 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import os
+from hla_tables import load_table, top_ranked
+
+# GLOBAL #
+# MHCFlurry supported allele list, shipped next to this file
+supported_location = os.path.join(os.path.dirname(os.path.abspath(__file__)), "supported_alleles.txt")
+
+# Location:(mtime, set of supported alleles), list stays loaded for life of process
+loaded_supported = {}
+
+
+# Method: normalise_allele
+# Goal: Single place for allele name clean up - remove letters at end of HLA id (ex. A*02:01g -> A*02:01)
+# Input: Allele ID from Be The Match table
+# Output: Normalised allele ID
+def normalise_allele(allele):
+    allele = str(allele).strip()
+    if not allele[-1].isnumeric():
+        allele = allele[:-1]
+    return allele
+
+
+# Method: load_supported
+# Goal: Load MHCFlurry supported allele list for constant time membership checks
+# Input: Text file with one supported allele per line
+# Output: Set of supported alleles, ex. HLA-A*02:01
+def load_supported(location=supported_location):
+    mtime = os.path.getmtime(location)
+    if location not in loaded_supported or loaded_supported[location][0] != mtime:
+        with open(location, "r") as f:
+            loaded_supported[location] = (mtime, set(line.strip() for line in f if line.strip() != ""))
+    return loaded_supported[location][1]
+
+
+# Method: grab_mhc
+# Goal: Generate allele/population dictionaries from rank and frequency columns, normalised and deduplicated
+# Input:
+#   xlsx_files: XLSX files from Be The Match Registry Haplotype Frequencies Tables
+#   rank_cutoff: Highest rank kept per population
+# Output:
+#   hlas_info: Population:Allele List
+#   hlas_inverse: Allele:Population List
+#   hlas_freq: Allele:{Population:freq}  ex. hlas_freq["C*07:01"]["NAM"] = 0.0000003
+def grab_mhc(xlsx_files, rank_cutoff=50.0):
+    hlas_info = {}  # Population:{Allele:None}, dictionary keeps order and removes repeats
+    hlas_freq = {}  # Allele:{Population:freq}
+    rank_headers = []
+    for file_in in xlsx_files:
+        df = load_table(file_in)  # Excel only parsed when columnar cache is missing or stale
+        if len(rank_headers) == 0:
+            rank_headers = [header for header in df.columns if header.endswith("_rank")]
+        locus = file_in.split('/')[-1].split(".")[0]  # Allele column named by first letter of file
+        for header in rank_headers:
+            population = header.split("_")[0]
+            if population not in hlas_info:
+                hlas_info[population] = {}
+            # Cutoff for rank of HLAs submitted
+            alleles_list, freq_list = top_ranked(df, locus, population, rank_cutoff)
+            for position in range(len(alleles_list)):
+                allele = normalise_allele(alleles_list[position])
+                hlas_info[population][allele] = None
+                if allele not in hlas_freq:
+                    hlas_freq[allele] = {}
+                hlas_freq[allele][population] = freq_list[position]
+    return build_maps(hlas_info, hlas_freq)
+
+
+# Method: build_maps
+# Goal: Turn Population:{Allele} into deduplicated Population:Allele List and Allele:Population List
+# Output: hlas_info, hlas_inverse, hlas_freq as in grab_mhc
+def build_maps(hlas_info, hlas_freq):
+    hlas_inverse = {}  # Allele:{Population:None}
+    for population in hlas_info:
+        for allele in hlas_info[population]:
+            if allele not in hlas_inverse:
+                hlas_inverse[allele] = {}
+            hlas_inverse[allele][population] = None
+    hlas_info = {population: list(alleles) for population, alleles in hlas_info.items()}
+    hlas_inverse = {allele: list(populations) for allele, populations in hlas_inverse.items()}
+    return hlas_info, hlas_inverse, hlas_freq
+
+
+# Method: unique_alleles
+# Goal: Collect every allele across populations once, in order first seen
+# Input: hlas_info: Population:Allele List
+# Output: List of alleles
+def unique_alleles(hlas_info):
+    return list(dict.fromkeys(allele for population in hlas_info for allele in hlas_info[population]))
+
+
+# Method: resolve_alleles
+# Goal: Split alleles into MHCFlurry supported (with HLA- prefix) and unsupported
+# Input:
+#   alleles: List of normalised alleles
+#   supported_alleles: Set from load_supported
+# Output:
+#   submit: List of supported alleles as named by MHCFlurry, ex. HLA-A*02:01
+#   unsupported: List of alleles MHCFlurry does not support
+def resolve_alleles(alleles, supported_alleles):
+    submit = []
+    unsupported = []
+    for allele in alleles:
+        full_allele = "HLA-" + allele
+        if full_allele in supported_alleles:
+            submit.append(full_allele)
+        else:
+            unsupported.append(allele)
+    return submit, unsupported
@@ -0,0 +1,407 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import hla_tables
+from allele_registry import grab_mhc, load_supported
+from binder_index import build_binder_index, coverage_table
+from fragment_to_infinity import fragment, grab_all_seq, select_alleles, stream_fragment_keys, stream_seq
+from mhc_analysis import binders, codes, process_file, read_predictions, sorted_affinities, sweep_table, \
+    weighted_scores
+from peptide_codec import alphabet, bits, decode_keys
+from peptide_index import build_peptide_index, index_peptides
+from predictors import predict_grid
+from stream_pipeline import run_streaming
+
+# GLOBAL #
+# Scale presets, unique peptides x alleles of each proteome is close to number of prediction rows
+scales = {"tiny": {"predictions": 10 ** 3, "proteins": 1, "length": 170, "alleles": 2},
+          "small": {"predictions": 10 ** 5, "proteins": 11, "length": 300, "alleles": 10},
+          "medium": {"predictions": 10 ** 6, "proteins": 42, "length": 400, "alleles": 20},
+          "large": {"predictions": 10 ** 7, "proteins": 210, "length": 400, "alleles": 40},
+          "huge": {"predictions": 10 ** 8, "proteins": 1100, "length": 500, "alleles": 60}}
+
+# Every stage, in the order run
+stage_names = ["grab_all_seq", "fragment", "peptide_index", "grab_mhc_excel", "grab_mhc_cached", "predict_fake",
+               "predict_stub_cli", "stream_pipeline", "read_predictions", "process_file", "weighted_scores",
+               "sweep", "binder_index"]
+
+# mhcflurry-predict compatible stub, scores with the fake backend in a separate process like the real CLI
+stub_source = '''#!{python}
+import sys
+sys.path.insert(0, {repo!r})
+import pandas as pd
+from predictors import score_fake
+pairs = pd.read_csv(sys.argv[1], dtype=str)
+frames = []
+for allele, group in pairs.groupby("allele", sort=False):
+    affinities, percentiles = score_fake(allele, group["peptide"].tolist())
+    frames.append(group.assign(mhcflurry_affinity=affinities, mhcflurry_affinity_percentile=percentiles))
+pd.concat(frames).to_csv(sys.argv[sys.argv.index("--out") + 1], index=False)
+'''
+
+
+# Method: generate_proteome
+# Goal: Synthetic proteome FASTA, UniProt style headers, about a tenth of proteins are point-mutated copies
+#   of an earlier protein so peptide deduplication has work to do
+# Input:
+#   fasta_out: Location of FASTA to write
+#   proteins: Number of proteins
+#   length: Mean protein length
+#   rng: NumPy random generator
+def generate_proteome(fasta_out, proteins, length, rng):
+    residues = np.frombuffer(alphabet[:20].encode(), dtype=np.uint8)
+    written = []
+    with open(fasta_out, "w") as f:
+        for number in range(proteins):
+            if len(written) > 0 and rng.random() < 0.1:
+                residue_codes = written[rng.integers(len(written))].copy()
+                mutated = rng.random(len(residue_codes)) < 0.05
+                residue_codes[mutated] = rng.integers(0, 20, mutated.sum())
+            else:
+                residue_codes = rng.integers(0, 20, max(20, int(rng.normal(length, length / 4))))
+            written.append(residue_codes)
+            seq = residues[residue_codes].tobytes().decode()
+            f.write(">sp|SYN" + str(number).zfill(6) + "|SYN" + str(number) + "_SYNTH Synthetic protein\n")
+            for start in range(0, len(seq), 60):
+                f.write(seq[start:start + 60] + "\n")
+
+
+# Method: generate_tables
+# Goal: Synthetic Be The Match haplotype tables (A, B and C workbooks) with real MHCFlurry allele names
+# Input:
+#   table_dir: Directory to write A.xlsx, B.xlsx, C.xlsx to
+#   alleles_per_locus: Alleles in each table
+#   rng: NumPy random generator
+# Output: List of workbook locations
+def generate_tables(table_dir, alleles_per_locus, rng):
+    supported = sorted(load_supported())
+    populations = codes["Race"] + codes["Broad_race"]
+    hla_files = []
+    for locus in ["A", "B", "C"]:
+        names = [allele.split("-", 1)[1] for allele in supported if allele.startswith("HLA-" + locus + "*")]
+        names = rng.permutation(names)[:alleles_per_locus].tolist()
+        table = {locus: names}
+        for population in sorted(populations):
+            freqs = rng.dirichlet(np.full(len(names), 0.5))
+            freqs[rng.random(len(names)) < 0.2] = 0.0  # Not seen in population
+            ranks = pd.Series(np.where(freqs > 0, freqs, np.nan)).rank(ascending=False, method="first")
+            table[population + "_freq"] = freqs
+            table[population + "_rank"] = ranks.to_numpy()
+        hla_file = os.path.join(table_dir, locus + ".xlsx")
+        pd.DataFrame(table).to_excel(hla_file, index=False, engine="openpyxl")
+        hla_files.append(hla_file)
+    return hla_files
+
+
+# Method: generate_predictions
+# Goal: MHCFlurry shaped predictions csv of random 9-mers, written in blocks so any scale fits in memory
+# Input:
+#   csv_out: Location of csv to write
+#   rows: Number of prediction rows
+#   alleles: List of alleles, ex. HLA-A*02:01
+#   rng: NumPy random generator
+#   block_rows: Rows generated at a time
+def generate_predictions(csv_out, rows, alleles, rng, block_rows=1000000):
+    peptides_per_block = max(1, block_rows // len(alleles))
+    shifts = np.arange(8, -1, -1, dtype=np.int64) * bits
+    written = 0
+    while written < rows:
+        # Random residue codes 1-20 packed as in peptide_codec, decoded in one call
+        keys = (rng.integers(1, 21, (peptides_per_block, 9)).astype(np.int64) << shifts).sum(axis=1)
+        peptides = np.array(decode_keys(keys), dtype=object)
+        block = pd.DataFrame({"allele": np.repeat(np.array(alleles, dtype=object), len(peptides)),
+                              "peptide": np.tile(peptides, len(alleles))})[:rows - written]
+        uniform = rng.random(len(block))
+        block["mhcflurry_affinity"] = 50000.0 ** uniform
+        block["mhcflurry_affinity_percentile"] = uniform * 100
+        block.to_csv(csv_out, mode="w" if written == 0 else "a", header=written == 0, index=False)
+        written += len(block)
+
+
+# Method: write_stub
+# Goal: Executable mhcflurry-predict stand-in for offline runs of the cli backend
+# Output: Location of stub
+def write_stub(data_dir):
+    stub_location = os.path.join(data_dir, "stub_predict")
+    with open(stub_location, "w") as f:
+        f.write(stub_source.format(python=sys.executable, repo=os.path.dirname(os.path.abspath(__file__))))
+    os.chmod(stub_location, 0o755)
+    return stub_location
+
+
+# Method: prepare_data
+# Goal: Generate synthetic proteome, haplotype tables and predictions for a scale, reused while settings match
+# Input:
+#   data_dir: Directory for generated data
+#   settings: Dictionary of predictions, proteins, length, alleles, seed
+#   regenerate: Generate even when data for settings exists
+# Output: Dictionary of fasta, hla_files, predictions, stub locations
+def prepare_data(data_dir, settings, regenerate=False):
+    os.makedirs(data_dir, exist_ok=True)
+    data = {"fasta": os.path.join(data_dir, "proteome.fasta"),
+            "hla_files": [os.path.join(data_dir, locus + ".xlsx") for locus in ["A", "B", "C"]],
+            "predictions": os.path.join(data_dir, "predictions.csv"), "stub": write_stub(data_dir)}
+    settings_location = os.path.join(data_dir, "settings.json")
+    if not regenerate and os.path.exists(settings_location) and os.path.exists(data["predictions"]):
+        with open(settings_location, "r") as f:
+            if json.load(f) == settings:
+                return data
+    rng = np.random.default_rng(settings["seed"])
+    start = time.perf_counter()
+    generate_proteome(data["fasta"], settings["proteins"], settings["length"], rng)
+    generate_tables(data_dir, settings["alleles"], rng)
+    hlas, hlas_inverse, hlas_freq = grab_mhc(data["hla_files"], 50.0)
+    alleles, unsupported_alleles = resolve_quietly(hlas)
+    generate_predictions(data["predictions"], settings["predictions"], alleles, rng)
+    with open(settings_location, "w") as f:
+        json.dump(settings, f)
+    print("Generated data in " + str(round(time.perf_counter() - start, 2)) + "s: " + data_dir)
+    return data
+
+
+# Method: resolve_quietly
+# Goal: select_alleles without its per allele messages
+def resolve_quietly(hlas):
+    stdout = sys.stdout
+    try:
+        sys.stdout = open(os.devnull, "w")
+        return select_alleles(hlas, load_supported())
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+# Method: build_stages
+# Goal: Every stage as a function returning its counts, state carried between stages in a dictionary
+# Input:
+#   data: Dictionary from prepare_data
+#   work_dir: Directory for stage outputs
+#   processes: MHCFlurry processes for stub cli stage
+# Output: Dictionary of stage name:function
+def build_stages(data, work_dir, processes=1):
+    state = {}
+    sizes = [9]
+    prediction_out = os.path.join(work_dir, "stage_predictions.csv")
+
+    def stage_grab_all_seq():
+        state["all_seq"] = grab_all_seq(data["fasta"])
+        return {"proteins": len(state["all_seq"])}
+
+    def stage_fragment():
+        fragments = fragment(state["all_seq"], sizes[0])
+        return {"fragments": sum(len(fragment_list) for fragment_list in fragments.values())}
+
+    def stage_peptide_index():
+        state["peptide_index"] = build_peptide_index(stream_fragment_keys(stream_seq(data["fasta"]), sizes))
+        state["peptides"] = index_peptides(state["peptide_index"])
+        return {"fragments": len(state["peptide_index"]["position"]), "unique_peptides": len(state["peptides"])}
+
+    def stage_grab_mhc_excel():
+        for hla_file in data["hla_files"]:
+            if os.path.exists(hla_tables.cache_location(hla_file)):
+                os.remove(hla_tables.cache_location(hla_file))
+        hla_tables.loaded_tables.clear()
+        hlas, hlas_inverse, hlas_freq = grab_mhc(data["hla_files"], 50.0)
+        return {"alleles": len(hlas_freq)}
+
+    def stage_grab_mhc_cached():
+        hla_tables.loaded_tables.clear()
+        hlas, hlas_inverse, hlas_freq = grab_mhc(data["hla_files"], 50.0)
+        state["alleles"], unsupported_alleles = resolve_quietly(hlas)
+        # Analysis uses rank 25 tables, as mhc_analysis
+        hlas, state["hlas_inverse"], state["hlas_freq"] = grab_mhc(data["hla_files"], 25.0)
+        return {"alleles_submitted": len(state["alleles"]), "alleles_unsupported": len(unsupported_alleles)}
+
+    def stage_predict_fake():
+        predict_grid(state["peptides"], state["alleles"], prediction_out, "fake")
+        return {"predictions": len(state["peptides"]) * len(state["alleles"])}
+
+    def stage_predict_stub_cli():
+        predict_grid(state["peptides"], state["alleles"], prediction_out, "cli", processes=processes,
+                     predictor=data["stub"])
+        return {"predictions": len(state["peptides"]) * len(state["alleles"])}
+
+    def stage_stream_pipeline():
+        stream = run_streaming(data["fasta"], sizes, state["alleles"], state["hlas_inverse"], state["hlas_freq"],
+                               workers=processes, backend="fake")
+        return {"predictions": stream["predictions"], "binders": len(stream["binders"])}
+
+    def stage_read_predictions():
+        state["binder_predictions"] = read_predictions(data["predictions"], 500)
+        return {"binder_rows": len(state["binder_predictions"])}
+
+    def stage_process_file():
+        state["binder_df"] = binders(process_file(state["binder_predictions"], state["hlas_inverse"],
+                                                  state["hlas_freq"]))
+        return {"binders": len(state["binder_df"])}
+
+    def stage_weighted_scores():
+        return {"scores": len(weighted_scores(state["binder_df"]))}
+
+    def stage_sweep():
+        sweep_predictions = read_predictions(data["predictions"], 5000)
+        table = sweep_table(sorted_affinities(sweep_predictions), state["hlas_inverse"], state["hlas_freq"],
+                            [50, 150, 500, 1000, 5000])
+        return {"rows": len(table)}
+
+    def stage_binder_index():
+        binder_index = build_binder_index(data["predictions"])
+        table = coverage_table(binder_index, state["hlas_freq"], codes["Broad_race"])
+        return {"indexed_peptides": len(binder_index["keys"]), "rows": len(table)}
+
+    return {"grab_all_seq": stage_grab_all_seq, "fragment": stage_fragment, "peptide_index": stage_peptide_index,
+            "grab_mhc_excel": stage_grab_mhc_excel, "grab_mhc_cached": stage_grab_mhc_cached,
+            "predict_fake": stage_predict_fake, "predict_stub_cli": stage_predict_stub_cli,
+            "stream_pipeline": stage_stream_pipeline, "read_predictions": stage_read_predictions,
+            "process_file": stage_process_file, "weighted_scores": stage_weighted_scores, "sweep": stage_sweep,
+            "binder_index": stage_binder_index}
+
+
+# Method: measure
+# Goal: Time a stage (best of repeats, wall and CPU) and its peak Python/NumPy memory in a separate traced run
+# Input:
+#   stage: Stage function
+#   repeat: Timed runs
+#   memory: Also run once under tracemalloc, tracing slows the run so it is never timed
+# Output: Dictionary of wall, cpu (seconds), peak_mb (None without memory) and counts
+def measure(stage, repeat=1, memory=True):
+    timings = []
+    counts = {}
+    for run in range(repeat):
+        gc.collect()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        counts = stage()
+        timings.append((time.perf_counter() - wall, time.process_time() - cpu))
+    peak_mb = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        stage()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    wall, cpu = min(timings)
+    return {"wall": round(wall, 4), "cpu": round(cpu, 4),
+            "peak_mb": None if peak_mb is None else round(peak_mb, 2), "counts": counts}
+
+
+# Method: load_baselines
+# Goal: Read stored baselines, empty when none saved yet
+def load_baselines(baseline_location):
+    if not os.path.exists(baseline_location):
+        return {}
+    with open(baseline_location, "r") as f:
+        return json.load(f)
+
+
+# Method: compare
+# Goal: Print stage results next to baseline, flag stages slower than tolerance
+# Input:
+#   results: Dictionary of stage:measure output
+#   baseline: Dictionary of stage:measure output from an earlier run, None if no baseline
+#   tolerance: Wall time ratio counted as a regression
+# Output: List of regressed stages
+def compare(results, baseline, tolerance):
+    regressions = []
+    print("stage".ljust(18) + "wall s".rjust(10) + "cpu s".rjust(10) + "peak MB".rjust(10) + "baseline".rjust(10)
+          + "ratio".rjust(8) + "  counts")
+    for name, result in results.items():
+        line = name.ljust(18) + str(result["wall"]).rjust(10) + str(result["cpu"]).rjust(10) \
+            + str(result["peak_mb"]).rjust(10)
+        if baseline is not None and name in baseline:
+            ratio = result["wall"] / max(baseline[name]["wall"], 1e-6)
+            line += str(baseline[name]["wall"]).rjust(10) + str(round(ratio, 2)).rjust(8)
+            if ratio > tolerance:
+                regressions.append(name)
+                line += " SLOWER"
+        else:
+            line += "-".rjust(10) + "-".rjust(8)
+        print(line + "  " + " ".join(key + "=" + str(value) for key, value in result["counts"].items()))
+    return regressions
+
+
+# Method: parse_args
+# Goal: Collect command line arguments from user
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", help="Scale preset (prediction rows 10^3 to 10^8)", type=str,
+                        choices=list(scales), default="small")
+    parser.add_argument("--predictions", help="Prediction rows in generated csv, overrides scale", type=int)
+    parser.add_argument("--proteins", help="Proteins in generated proteome, overrides scale", type=int)
+    parser.add_argument("--length", help="Mean protein length, overrides scale", type=int)
+    parser.add_argument("--alleles", help="Alleles per locus in generated tables, overrides scale", type=int)
+    parser.add_argument("--seed", help="Random seed for generated data", type=int, default=8300)
+    parser.add_argument("--stages", help="Stages to run (default all)", type=str, nargs="+", choices=stage_names)
+    parser.add_argument("--repeat", help="Timed runs per stage, best is kept", type=int, default=1)
+    parser.add_argument("--no_memory", help="Skip traced run for peak memory", action="store_true", default=False)
+    parser.add_argument("-p", "--processes", help="Processes for stub cli stage and workers for stream stage",
+                        type=int, default=1)
+    parser.add_argument("--data_dir", help="Generated data and stage outputs", type=str, default="benchmark_data")
+    parser.add_argument("--regenerate", help="Generate data even if it exists", action="store_true", default=False)
+    parser.add_argument("--baseline", help="Baselines json, defaults to baseline.json in --data_dir", type=str)
+    parser.add_argument("--save_baseline", help="Store this run as baseline for its scale", action="store_true",
+                        default=False)
+    parser.add_argument("--tolerance", help="Wall time ratio to baseline counted as slower", type=float,
+                        default=1.25)
+    parser.add_argument("--check", help="Exit with status 1 when a stage is slower than baseline",
+                        action="store_true", default=False)
+    parser.add_argument("--report", help="Write results as json", type=str)
+    return parser.parse_args()
+
+
+# Method: main
+# Goal: Control the operation of program
+def main():
+    args = parse_args()
+    settings = dict(scales[args.scale], seed=args.seed)
+    for option in ["predictions", "proteins", "length", "alleles"]:
+        if getattr(args, option) is not None:
+            settings[option] = getattr(args, option)
+    # Scale key names the data set, overridden presets and seeds get their own directory and baseline
+    scale_key = args.scale
+    if settings != dict(scales[args.scale], seed=8300):
+        scale_key = "_".join(str(settings[option]) for option in ["predictions", "proteins", "length", "alleles",
+                                                                  "seed"])
+    data_dir = os.path.join(args.data_dir, scale_key)
+    data = prepare_data(data_dir, settings, args.regenerate)
+    stages = build_stages(data, data_dir, args.processes)
+    selected = args.stages if args.stages else stage_names
+    results = {}
+    # Earlier stages fill state later ones use, they run untimed when not selected
+    for name in stage_names[:max(stage_names.index(name) for name in selected) + 1]:
+        if name in selected:
+            print("Stage " + name + "...")
+            results[name] = measure(stages[name], args.repeat, not args.no_memory)
+        elif name in ["grab_all_seq", "peptide_index", "grab_mhc_cached", "read_predictions", "process_file"]:
+            stages[name]()
+    baseline_location = args.baseline or os.path.join(args.data_dir, "baseline.json")
+    baselines = load_baselines(baseline_location)
+    regressions = compare(results, baselines.get(scale_key), args.tolerance)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("Scale: " + scale_key + " Peak RSS: " + str(round(peak_rss_mb, 1)) + " MB")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"scale": scale_key, "settings": settings, "peak_rss_mb": peak_rss_mb, "stages": results}, f,
+                      indent=1)
+        print("Report: " + args.report)
+    if args.save_baseline:
+        baselines[scale_key] = dict(baselines.get(scale_key, {}), **results)
+        with open(baseline_location, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print("Baseline saved: " + baseline_location)
+    if args.check and len(regressions) > 0:
+        sys.exit("Slower than baseline: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
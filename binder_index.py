@@ -0,0 +1,206 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import numpy as np
+import pandas as pd
+from peptide_codec import decode_keys, encode_peptides
+
+# GLOBAL #
+# Affinity buckets in nM, bucket b holds peptides binding at thresholds[b] or better
+default_thresholds = [50.0, 150.0, 500.0, 1000.0, 5000.0]
+
+# Number of set bits in each byte value
+popcount_table = np.array([bin(value).count("1") for value in range(256)], dtype=np.int64)
+
+
+# Method: build_binder_index
+# Goal: Precompute bitset per allele and affinity bucket over the set of unique binding peptides
+# Input:
+#   prediction_file: MHCFlurry output csv
+#   thresholds: Affinity buckets in nM
+#   chunk_size: Prediction rows read at a time
+#   Rows whose peptide cannot be packed in an int64 key (over 12 residues or unknown residues) are left out
+#   and reported, they would otherwise all share key -1 and count as one peptide
+# Output: Dictionary holding
+#   thresholds: float array of buckets
+#   alleles: List of alleles, ex. A*02:01 (HLA- prefix removed)
+#   keys: int64 array of unique peptide keys binding any allele at largest threshold
+#   bits: uint8 array [allele, bucket, packed peptide bits]
+def build_binder_index(prediction_file, thresholds=default_thresholds, chunk_size=1000000):
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    allele_parts = []
+    key_parts = []
+    affinity_parts = []
+    skipped = 0
+    # Only rows binding at loosest threshold are kept, memory follows number of binders
+    for chunk in pd.read_csv(prediction_file, usecols=["allele", "peptide", "mhcflurry_affinity"],
+                             dtype={"allele": "category"}, chunksize=chunk_size):
+        chunk = chunk[chunk["mhcflurry_affinity"] <= thresholds[-1]]
+        chunk_keys = encode_peptides(chunk["peptide"])
+        packed = chunk_keys >= 0
+        skipped += int((~packed).sum())
+        allele_parts.append(chunk["allele"].astype(str).to_numpy()[packed])
+        key_parts.append(chunk_keys[packed])
+        affinity_parts.append(chunk["mhcflurry_affinity"].to_numpy()[packed])
+    if skipped > 0:
+        print("Binder rows not indexed (peptide over 12 residues or unknown residues): " + str(skipped))
+    all_alleles = np.concatenate(allele_parts) if len(allele_parts) > 0 else np.empty(0, dtype=str)
+    alleles, allele_rows = np.unique(all_alleles, return_inverse=True)
+    keys, peptide_columns = np.unique(np.concatenate(key_parts) if len(key_parts) > 0
+                                      else np.empty(0, dtype=np.int64), return_inverse=True)
+    affinities = np.concatenate(affinity_parts) if len(affinity_parts) > 0 else np.empty(0)
+    bits = np.zeros((len(alleles), len(thresholds), (len(keys) + 7) // 8), dtype=np.uint8)
+    byte_columns = peptide_columns // 8
+    masks = (np.uint8(128) >> (peptide_columns % 8)).astype(np.uint8)  # Same bit order as np.packbits
+    for bucket in range(len(thresholds)):
+        selected = affinities <= thresholds[bucket]
+        np.bitwise_or.at(bits, (allele_rows[selected], bucket, byte_columns[selected]), masks[selected])
+    return {"thresholds": thresholds, "alleles": [allele.split("-", 1)[-1] for allele in alleles.tolist()],
+            "keys": keys, "bits": bits}
+
+
+# Method: save_binder_index
+# Goal: Write binder index to .npz file, written as given (no extension added)
+def save_binder_index(binder_index, output_location):
+    with open(output_location, "wb") as f:
+        np.savez(f, thresholds=binder_index["thresholds"], alleles=np.array(binder_index["alleles"], dtype=str),
+                 keys=binder_index["keys"], bits=binder_index["bits"])
+
+
+# Method: load_binder_index
+# Goal: Read binder index written by save_binder_index
+def load_binder_index(file_in):
+    with np.load(file_in, allow_pickle=False) as saved:
+        return {"thresholds": saved["thresholds"], "alleles": saved["alleles"].tolist(), "keys": saved["keys"],
+                "bits": saved["bits"]}
+
+
+# Method: bucket_of
+# Goal: Bucket number for an affinity threshold, threshold must be one the index was built with
+def bucket_of(binder_index, threshold):
+    matches = np.nonzero(binder_index["thresholds"] == float(threshold))[0]
+    if len(matches) == 0:
+        raise ValueError("Threshold " + str(threshold) + " not in index buckets "
+                         + str(binder_index["thresholds"].tolist()))
+    return matches[0]
+
+
+# Method: peptide_mask
+# Goal: Packed bitset of a peptide set over index peptides
+# Input:
+#   binder_index: Binder index
+#   peptides: List of peptides, None for every peptide in index
+# Output: uint8 array of packed bits
+def peptide_mask(binder_index, peptides=None):
+    selected = np.ones(len(binder_index["keys"]), dtype=bool)
+    if peptides is not None:
+        selected = np.isin(binder_index["keys"], encode_peptides(peptides))
+    return np.packbits(selected)
+
+
+# Method: binder_counts
+# Goal: Number of binding peptides per allele at threshold, popcount of each bitset
+# Output: Series of Allele:count
+def binder_counts(binder_index, threshold=500):
+    bits = binder_index["bits"][:, bucket_of(binder_index, threshold), :]
+    return pd.Series(popcount_table[bits].sum(axis=1), index=binder_index["alleles"])
+
+
+# Method: allele_frequencies
+# Goal: Frequency and locus of each index allele within a population
+# Input:
+#   binder_index: Binder index
+#   hlas_freq: Allele:{Population:freq}
+#   population: Population code
+# Output: float array of frequencies (0 when allele not ranked in population) and array of locus letters
+def allele_frequencies(binder_index, hlas_freq, population):
+    freqs = np.array([hlas_freq.get(allele, {}).get(population, 0.0) for allele in binder_index["alleles"]],
+                     dtype=float)
+    loci = np.array([allele.split("*")[0] for allele in binder_index["alleles"]])
+    return np.nan_to_num(freqs), loci
+
+
+# Method: coverage_from_alleles
+# Goal: Fraction of population carrying at least one covered allele
+#   Per locus, chance an individual carries no covered allele is (1 - covered allele frequency)^2
+# Input: freqs, loci from allele_frequencies and boolean array of covered alleles
+# Output: Coverage between 0 and 1
+def coverage_from_alleles(freqs, loci, covered):
+    uncovered = 1.0
+    for locus in np.unique(loci):
+        locus_freq = min(freqs[(loci == locus) & covered].sum(), 1.0)
+        uncovered *= (1.0 - locus_freq) ** 2
+    return 1.0 - uncovered
+
+
+# Method: population_coverage
+# Goal: Population coverage of a peptide set at threshold with bit operations
+# Input:
+#   binder_index: Binder index
+#   hlas_freq: Allele:{Population:freq}
+#   population: Population code
+#   threshold: Affinity threshold in nM, one of index buckets
+#   peptides: List of peptides, None for every peptide in index
+# Output: Coverage between 0 and 1
+def population_coverage(binder_index, hlas_freq, population, threshold=500, peptides=None):
+    bits = binder_index["bits"][:, bucket_of(binder_index, threshold), :]
+    covered = (bits & peptide_mask(binder_index, peptides)).any(axis=1)
+    freqs, loci = allele_frequencies(binder_index, hlas_freq, population)
+    return coverage_from_alleles(freqs, loci, covered)
+
+
+# Method: coverage_table
+# Goal: Coverage of a peptide set for every population and every threshold bucket
+# Input:
+#   binder_index: Binder index
+#   hlas_freq: Allele:{Population:freq}
+#   populations: List of population codes, ex. codes["Race"] + codes["Broad_race"]
+#   peptides: List of peptides, None for every peptide in index
+# Output: DataFrame of Population, Threshold, Coverage
+def coverage_table(binder_index, hlas_freq, populations, peptides=None):
+    mask = peptide_mask(binder_index, peptides)
+    # Which alleles bind any peptide of set, every bucket at once
+    covered = (binder_index["bits"] & mask).any(axis=2)
+    rows = []
+    for population in populations:
+        freqs, loci = allele_frequencies(binder_index, hlas_freq, population)
+        for bucket in range(len(binder_index["thresholds"])):
+            rows.append([population, binder_index["thresholds"][bucket],
+                         coverage_from_alleles(freqs, loci, covered[:, bucket])])
+    return pd.DataFrame(rows, columns=["Population", "Threshold", "Coverage"])
+
+
+# Method: minimum_peptide_set
+# Goal: Greedy smallest peptide set reaching target coverage of a population
+#   Each step scores every candidate peptide at once from the unpacked bitsets of still uncovered alleles
+# Input:
+#   binder_index: Binder index
+#   hlas_freq: Allele:{Population:freq}
+#   population: Population code
+#   target: Coverage wanted, between 0 and 1
+#   threshold: Affinity threshold in nM, one of index buckets
+# Output: List of peptides in order picked and coverage reached
+def minimum_peptide_set(binder_index, hlas_freq, population, target=0.9, threshold=500):
+    bits = binder_index["bits"][:, bucket_of(binder_index, threshold), :]
+    freqs, loci = allele_frequencies(binder_index, hlas_freq, population)
+    covered = np.zeros(len(freqs), dtype=bool)
+    picked = []
+    coverage = 0.0
+    locus_names = np.unique(loci)
+    while coverage < target:
+        candidates = np.nonzero(~covered & (freqs > 0))[0]
+        if len(candidates) == 0:
+            break
+        binds = np.unpackbits(bits[candidates], axis=1, count=len(binder_index["keys"])).astype(bool)
+        uncovered = np.ones(binds.shape[1])
+        for locus in locus_names:
+            in_locus = loci[candidates] == locus
+            locus_freq = freqs[(loci == locus) & covered].sum() + freqs[candidates[in_locus]] @ binds[in_locus]
+            uncovered *= (1.0 - np.minimum(locus_freq, 1.0)) ** 2
+        best = int(np.argmax(1.0 - uncovered))
+        if 1.0 - uncovered[best] <= coverage:
+            break  # No peptide adds coverage
+        picked.append(best)
+        covered[candidates[binds[:, best]]] = True
+        coverage = 1.0 - uncovered[best]
+    return decode_keys(binder_index["keys"][picked]), coverage
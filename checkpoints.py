@@ -0,0 +1,89 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import hashlib
+import json
+import os
+from run_report import stage
+
+
+# Method: hash_file
+# Goal: SHA-256 of file contents
+def hash_file(file_in):
+    sha = hashlib.sha256()
+    with open(file_in, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Method: stage_key
+# Goal: Hash of everything a stage depends on (settings and upstream artifact hashes)
+# Input: JSON serialisable stage inputs
+# Output: Hex string
+def stage_key(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+# Method: load_manifest
+# Goal: Read run manifest, empty manifest for a new run
+# Input: Run directory
+# Output: Dictionary of stages:{Stage:{key, artifact, sha256}}
+def load_manifest(run_dir):
+    manifest_location = os.path.join(run_dir, "manifest.json")
+    if not os.path.exists(manifest_location):
+        return {"stages": {}}
+    with open(manifest_location, "r") as f:
+        return json.load(f)
+
+
+# Method: save_manifest
+# Goal: Write run manifest, replaced in one step so a crash never leaves half a manifest
+def save_manifest(run_dir, manifest):
+    manifest_location = os.path.join(run_dir, "manifest.json")
+    with open(manifest_location + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_location + ".tmp", manifest_location)
+
+
+# Method: store_artifact
+# Goal: Move finished stage output into artifacts directory under name of its content hash
+# Input:
+#   run_dir: Run directory
+#   file_in: Finished stage output
+#   extension: File extension kept on artifact, ex. .csv
+# Output: Artifact location and SHA-256
+def store_artifact(run_dir, file_in, extension):
+    sha = hash_file(file_in)
+    artifact_dir = os.path.join(run_dir, "artifacts")
+    os.makedirs(artifact_dir, exist_ok=True)
+    artifact = os.path.join(artifact_dir, sha + extension)
+    os.replace(file_in, artifact)
+    return artifact, sha
+
+
+# Method: run_stage
+# Goal: Run pipeline stage unless resuming and manifest shows it finished with same inputs
+# Input:
+#   run_dir: Run directory
+#   manifest: Manifest from load_manifest, updated in place
+#   name: Stage name
+#   inputs: JSON serialisable stage inputs, a change reruns the stage
+#   build: Function writing stage output to the location it is given
+#   extension: File extension of artifact
+#   resume: Reuse finished stages
+# Output: Artifact location and SHA-256
+def run_stage(run_dir, manifest, name, inputs, build, extension, resume):
+    key = stage_key(inputs)
+    entry = manifest["stages"].get(name)
+    if resume and entry is not None and entry["key"] == key and os.path.exists(entry["artifact"]):
+        print("Stage " + name + " complete, skipped")
+        return entry["artifact"], entry["sha256"]
+    print("Stage " + name + "...")
+    partial = os.path.join(run_dir, name + ".partial" + extension)
+    with stage(name):
+        build(partial)
+    artifact, sha = store_artifact(run_dir, partial, extension)
+    manifest["stages"][name] = {"key": key, "artifact": artifact, "sha256": sha}
+    save_manifest(run_dir, manifest)
+    return artifact, sha
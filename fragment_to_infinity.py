@@ -2,8 +2,64 @@
 # Version: 1.0
 # Last Updated: December 10th, 2021
 import argparse
-import subprocess
+import csv
+import gzip
+import json
+import os
+import shutil
+import numpy as np
 import pandas as pd
+from allele_registry import grab_mhc, load_supported, resolve_alleles, supported_location, unique_alleles
+from checkpoints import hash_file, load_manifest, run_stage, stage_key
+from peptide_codec import decode_keys, encode_peptides, encode_sequence, max_length, window_keys
+from peptide_index import build_peptide_index, duplication_factor, index_peptides, load_peptide_index, \
+    save_peptide_index, write_occurrences
+from prediction_cache import run_cached
+from predictors import backend_version, backends, predict_grid
+from run_report import count, run_report, stage
+
+
+# Method: open_fasta
+# Goal: Open FASTA file for reading, plain or gzipped
+# Input: Protein sequence FASTA file (.gz for gzipped)
+# Output: Text file handle
+def open_fasta(fasta_in):
+    if fasta_in.endswith(".gz"):
+        return gzip.open(fasta_in, "rt")
+    return open(fasta_in, "r")
+
+
+# Method: parse_header
+# Goal: Collect protein ID from FASTA header - UniProt style (db|ID|name) or first word of header
+# Input: Header line of FASTA file
+# Output: Protein ID
+def parse_header(line):
+    header = line[1:].strip()
+    if "|" in header:
+        return header.split("|")[1]
+    if header == "":
+        return ""
+    return header.split()[0]
+
+
+# Method: stream_seq
+# Goal: Collect protein chains from FASTA file one at a time, only one sequence is held in memory
+# Input: Protein sequence FASTA file
+# Output: Generator of (protein ID, sequence)
+def stream_seq(fasta_in):
+    with open_fasta(fasta_in) as f1:
+        current_id = ""
+        chunks = []  # Sequence lines of current protein
+        for line in f1:
+            if line.startswith(">"):
+                if current_id != "":
+                    yield current_id, "".join(chunks)
+                current_id = parse_header(line)
+                chunks = []
+            elif current_id != "":
+                chunks.append(line.strip())
+        if current_id != "":
+            yield current_id, "".join(chunks)
 
 
 # Method: grab_all_seq
@@ -12,17 +68,38 @@ import pandas as pd
 # Output: Return dictionary of protein ID and sequence
 def grab_all_seq(fasta_in):
     all_seq = {}  # ID:Seq
-    with open(fasta_in, "r") as f1:
-        current_id = ""
-        for line in f1:
-            if line[0] == ">":
-                current_id = line.split("|")[1]
-                all_seq[current_id] = ""
-            elif current_id != "":
-                all_seq[current_id] += line[:-1]
+    for current_id, seq in stream_seq(fasta_in):
+        all_seq[current_id] = seq
     return all_seq
 
 
+# Method: stream_fragments
+# Goal: Lazily fragment each protein chain into all possible x-mers for each size requested
+# Input:
+#   seqs: Iterable of (protein ID, sequence), ex. stream_seq() or all_seq.items()
+#   sizes: List of fragment sizes
+# Output: Generator of (protein ID, position, fragment)
+def stream_fragments(seqs, sizes):
+    for current_id, seq in seqs:
+        for size in sizes:
+            for position in range(0, len(seq) - size + 1):
+                yield current_id, position, seq[position:position + size]
+
+
+# Method: stream_fragment_keys
+# Goal: Fragment each protein chain into int64 encoded x-mers with a vectorised sliding window
+# Input:
+#   seqs: Iterable of (protein ID, sequence), ex. stream_seq() or all_seq.items()
+#   sizes: List of fragment sizes
+# Output: Generator of (protein ID, int64 array of fragment keys, array of positions), see peptide_codec
+def stream_fragment_keys(seqs, sizes):
+    for current_id, seq in seqs:
+        codes = encode_sequence(seq)
+        windows = [window_keys(codes, size) for size in sizes]
+        yield current_id, np.concatenate([keys for keys, positions in windows]), \
+            np.concatenate([positions for keys, positions in windows])
+
+
 # Method: fragment
 # Goal: Upon each submitted protein chain, fragment into all possible x-mers.
 # Input: Dictionary of protein sequences and fragment size
@@ -30,132 +107,382 @@ def grab_all_seq(fasta_in):
 def fragment(seqs, size):
     fragment_dic = {}  # ID: Fragment List
     for current_id in seqs:
-        if current_id not in fragment_dic.keys():
-            fragment_dic[current_id] = []
-        for position in range(0, len(seqs[current_id]) - size + 1):
-            fragment_dic[current_id].append(seqs[current_id][position:position + size])
+        fragment_dic[current_id] = []
+    for current_id, position, fragment_ in stream_fragments(seqs.items(), [size]):
+        fragment_dic[current_id].append(fragment_)
     return fragment_dic
 
 
-# Method: grab_mhc
-# Goal: Create a dictionary of HLAs based on population frequency rank
-# Input: XLSX file from Be The Match Registry Haplotype Frequencies Tables
-# Output: Dictionary containing Population as Key and HLA IDs for HLAs ranked in the top 50 per population
-def grab_mhc(xlsx_files):
-    hlas_info = {}  # Population:IDs > 50 rank
-    first_file = True
-    rank_headers = []
-    for file_in in xlsx_files:
-        df = pd.read_excel(file_in, engine='openpyxl')
-        if first_file:
-            headers = df.columns  # All headers in file
-            for header in headers:
-                if header.endswith("_rank"):
-                    if header not in rank_headers:
-                        rank_headers.append(header)
-            first_file = False
-        for header in rank_headers:
-            if header not in hlas_info.keys():
-                hlas_info[header] = []
-            # Cutoff for rank of HLAs submitted
-            # May change from rank to a different measure at some point
-            df_top = df[df[header] <= 50.0]
-            # Send in first letter of file
-            hlas_info[header] = hlas_info[header] + df_top[file_in.split('/')[-1].split(".")[0]].values.tolist()
-    return hlas_info
+# Method: count_index
+# Goal: Record protein, fragment and unique peptide counts of a peptide index in run report
+def count_index(peptide_index):
+    count("proteins", len(peptide_index["proteins"]))
+    count("fragments", len(peptide_index["position"]))
+    count("unique_peptides", len(peptide_index["keys"]))
+
+
+# Method: select_alleles
+# Goal: Every allele once across populations, split by MHCFlurry support
+# Input:
+#   hlas_info: dictionary of HLAs for each populations to be ran, from allele_registry.grab_mhc
+#   supported_alleles: Set of supported alleles for MHCFlurry, from allele_registry.load_supported
+# Output:
+#   alleles: List of alleles to submit, ex. HLA-A*02:01
+#   unsupported_alleles: List of alleles that were ranked in population but not in MHCFlurry supported list
+def select_alleles(hlas_info, supported_alleles):
+    alleles, unsupported_alleles = resolve_alleles(unique_alleles(hlas_info), supported_alleles)
+    count("alleles_submitted", len(alleles))
+    count("alleles_unsupported", len(unsupported_alleles))
+    for allele in unsupported_alleles:
+        print("Unsupported allele: HLA-" + allele)
+    return alleles, unsupported_alleles
+
+
+# Method: predict_alleles
+# Goal: Predict every allele x peptide pair, through prediction cache if one is given
+# Input:
+#   peptides: List of unique peptides
+#   alleles: List of alleles to submit, from select_alleles
+#   output_location, chunk_size, processes, retries, predictor, cache_location, cache_version, cache_max, backend,
+#   models_dir: As in run_mhcflurry
+#   chunk_dir: Directory kept for chunks so an interrupted run can resume, None for temporary directory
+# Output: Location of resulting MHCFlurry output file
+def predict_alleles(peptides, alleles, output_location="predictions.csv", chunk_size=5000, processes=1, retries=2,
+                    predictor="mhcflurry-predict", cache_location=None, cache_version=None, cache_max=None,
+                    backend="cli", models_dir=None, chunk_dir=None):
+    count("predictions", len(peptides) * len(dict.fromkeys(alleles)))
+    if cache_location is None:
+        predict_grid(peptides, alleles, output_location, backend, chunk_size, processes, retries, predictor,
+                     models_dir, chunk_dir)
+    else:
+        if cache_version is None:
+            cache_version = backend_version(backend, predictor, models_dir)
+        cache_run = run_cached(peptides, alleles, output_location, cache_location, cache_version, cache_max,
+                               chunk_size, processes, retries, predictor, backend, models_dir, chunk_dir)
+        print("Cache hits: " + str(cache_run["hits"]) + " Cache misses: " + str(cache_run["misses"]))
+        count("cache_hits", cache_run["hits"])
+        count("cache_misses", cache_run["misses"])
+    return output_location
 
 
 # Method: run_mhcflurry
-# Goal: Automated submission of HLA and peptide pairs in batch submission to MHCFlurry
+# Goal: Automated submission of HLA and peptide pairs in chunked batches to MHCFlurry
 # Input:
-#   fragments: dictionary of proteome fragments
-#   hlas_info: dictionary of HLAs for each populations to be ran
-#   supported_alleles: Text file containing supported alleles for MHCFlurry
+#   peptides: List of unique peptides, ex. index_peptides(build_peptide_index(...))
+#   hlas_info: dictionary of HLAs for each populations to be ran, from allele_registry.grab_mhc
+#   supported_alleles: Set of supported alleles for MHCFlurry, from allele_registry.load_supported
+#   output_location: Location of resulting MHCFlurry output file
+#   chunk_size: Number of peptides per MHCFlurry work unit
+#   processes: Number of MHCFlurry processes run at once
+#   retries: Number of additional attempts for a failed work unit
+#   predictor: MHCFlurry executable (or compatible stub)
+#   cache_location: SQLite prediction cache, only pairs missing from it are predicted (None to disable)
+#   cache_version: Predictor version key for cache entries, None for default of backend
+#   cache_max: Maximum number of cached predictions, None for unbounded
+#   backend: "cli" (mhcflurry-predict subprocesses), "inprocess" (model loaded once) or "fake" (deterministic)
+#   models_dir: Directory of MHCFlurry models for in-process backend
 # Output:
 #   output_location: Location of resulting MHCFlurry output file
 #   unsupported_alleles: List of alleles that were ranked in population but not in MHCFlurry supported list
-def run_mhcflurry(fragments, hlas_info, supported_alleles):
-    # Program
-    commands = ["mhcflurry-predict"]
-    # Keep track of unsupported alleles
-    unsupported_alleles = []
-    # Append alleles here
-    commands.append("--alleles")
-    for population in hlas_info:
-        for allele in hlas_info[population]:
-            if not allele[-1].isnumeric():
-                allele = allele[:-1]
-            full_allele = "HLA-" + allele
-            if full_allele in supported_alleles:
-                commands.append(full_allele)
-            else:
-                print("Unsupported allele: " + full_allele)
-                unsupported_alleles.append(allele)  # Remove after for comparison at end
-    # Append peptides
-    commands.append("--peptides")
-    for current_id in fragments:
-        for fragment_ in fragments[current_id]:
-            commands.append(fragment_)
-    # commands.append(peptide_line[:-1])
-    # Append output
-    output_location = "predictions.csv"
-    commands.append("--out")
-    commands.append(output_location)
-    subprocess.run(commands)
+def run_mhcflurry(peptides, hlas_info, supported_alleles, output_location="predictions.csv", chunk_size=5000,
+                  processes=1, retries=2, predictor="mhcflurry-predict", cache_location=None,
+                  cache_version=None, cache_max=None, backend="cli", models_dir=None):
+    alleles, unsupported_alleles = select_alleles(hlas_info, supported_alleles)
+    predict_alleles(peptides, alleles, output_location, chunk_size, processes, retries, predictor, cache_location,
+                    cache_version, cache_max, backend, models_dir)
     return output_location, unsupported_alleles
 
 
+# Method: hla_file_list
+# Goal: Collect HLA XLSX files given on command line
+def hla_file_list(args):
+    hla_files = []
+    if args.a:
+        hla_files.append(args.a)
+    if args.b:
+        hla_files.append(args.b)
+    if args.c:
+        hla_files.append(args.c)
+    return hla_files
+
+
+# Method: write_fasta
+# Goal: Write parsed proteins back out as plain FASTA (>ID then sequence), readable by stream_seq
+def write_fasta(seqs, output_location):
+    with open(output_location, "w") as f:
+        for current_id, seq in seqs:
+            f.write(">" + current_id + "\n" + seq + "\n")
+
+
+# Method: write_alleles
+# Goal: Save allele selection (alleles submitted, unsupported alleles and their populations) as JSON
+def write_alleles(hla_files, output_location):
+    hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files, 50.0)
+    alleles, unsupported_alleles = select_alleles(hlas, load_supported())
+    with open(output_location, "w") as f:
+        json.dump({"alleles": alleles, "unsupported": unsupported_alleles,
+                   "populations": {allele: hlas_inverse[allele] for allele in unsupported_alleles}}, f, indent=1)
+
+
+# Method: run_staged
+# Goal: Run pipeline as checkpointed stages parse -> fragment -> alleles -> predict -> merge
+#   Each stage writes a content-addressed artifact into run directory and records it in manifest.json,
+#   with --resume finished stages and finished prediction chunks are skipped
+# Input: Command line arguments
+# Output:
+#   results_final: Location of predictions csv
+#   occurrences_final: Location of peptide occurrences csv
+def run_staged(args):
+    run_dir = os.path.abspath(args.run_dir)
+    os.makedirs(run_dir, exist_ok=True)
+    manifest = load_manifest(run_dir)
+    resume = args.resume
+    # parse - normalised FASTA of every protein
+    parsed, parsed_sha = run_stage(run_dir, manifest, "parse", {"fasta": hash_file(args.fasta)},
+                                   lambda out: write_fasta(stream_seq(args.fasta), out), ".fasta", resume)
+    # fragment - peptide index arrays
+    sizes = [size + 1 for size in args.size]
+    indexed, indexed_sha = run_stage(run_dir, manifest, "fragment", {"parse": parsed_sha, "sizes": sizes},
+                                     lambda out: save_peptide_index(build_peptide_index(
+                                         stream_fragment_keys(stream_seq(parsed), sizes)), out), ".npz", resume)
+    peptide_index = load_peptide_index(indexed)
+    count_index(peptide_index)
+    print("Unique peptides: " + str(len(peptide_index["keys"])) + " Duplication factor: "
+          + str(round(duplication_factor(peptide_index), 3)))
+    # alleles - supported alleles to submit
+    hla_files = hla_file_list(args)
+    selected, selected_sha = run_stage(run_dir, manifest, "alleles",
+                                       {"hla_files": [hash_file(file_in) for file_in in hla_files],
+                                        "supported": hash_file(supported_location), "rank": 50.0},
+                                       lambda out: write_alleles(hla_files, out), ".json", resume)
+    with open(selected, "r") as f:
+        selection = json.load(f)
+    # predict - chunks kept in run directory under stage key, finished chunks survive a crash
+    predict_inputs = {"fragment": indexed_sha, "alleles": selected_sha, "backend": args.backend,
+                      "predictor": args.predictor, "models_dir": args.models_dir, "chunk_size": args.chunk_size,
+                      "cache_version": args.cache_version or backend_version(args.backend, args.predictor,
+                                                                             args.models_dir)}
+    chunk_dir = os.path.join(run_dir, "chunks", stage_key(predict_inputs)[:16])
+    if not resume and os.path.exists(chunk_dir):
+        # Chunk outputs left by a crashed run are only reused with --resume
+        shutil.rmtree(chunk_dir)
+    predicted, predicted_sha = run_stage(run_dir, manifest, "predict", predict_inputs,
+                                         lambda out: predict_alleles(index_peptides(peptide_index),
+                                                                     selection["alleles"], out, args.chunk_size,
+                                                                     args.processes, args.retries, args.predictor,
+                                                                     args.cache, args.cache_version, args.cache_max,
+                                                                     args.backend, args.models_dir, chunk_dir),
+                                         ".csv", resume)
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
+        if len(os.listdir(os.path.dirname(chunk_dir))) == 0:
+            os.rmdir(os.path.dirname(chunk_dir))
+    # merge - peptide provenance, then copy results to requested output location
+    occurrences, occurrences_sha = run_stage(run_dir, manifest, "merge", {"fragment": indexed_sha,
+                                                                          "predict": predicted_sha},
+                                             lambda out: write_occurrences(peptide_index, out), ".csv", resume)
+    results_final = args.out
+    occurrences_final = os.path.splitext(results_final)[0] + "_occurrences.csv"
+    shutil.copyfile(predicted, results_final)
+    shutil.copyfile(occurrences, occurrences_final)
+    for allele in selection["unsupported"]:
+        print("Allele not found: " + allele + " Population: " + ", ".join(selection["populations"][allele]))
+    return results_final, occurrences_final
+
+
+# Method: read_batch
+# Goal: Read batch manifest - csv with name, fasta and sizes (space separated, same as -s) columns
+# Input: Manifest csv, relative fasta locations are taken from the manifest's directory
+# Output: List of job dictionaries {name, fasta, sizes}
+def read_batch(manifest_in):
+    jobs = []
+    names = set()
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_in))
+    with open(manifest_in, "r") as f:
+        for row in csv.DictReader(f):
+            name = row["name"].strip()
+            if name in names:
+                # Jobs write <name>_predictions.csv, a repeated name would overwrite an earlier job
+                raise ValueError("Duplicate job name in " + manifest_in + ": " + name)
+            names.add(name)
+            sizes = [int(size) for size in row["sizes"].split()]
+            if any(size + 1 > max_length for size in sizes):
+                # Same limit as -s, checked before allele tables are loaded
+                raise ValueError("Job " + name + " in " + manifest_in + ": sizes must be at most "
+                                 + str(max_length - 1))
+            jobs.append({"name": name, "fasta": os.path.join(manifest_dir, row["fasta"].strip()), "sizes": sizes})
+    return jobs
+
+
+# Method: split_batch
+# Goal: Split shared predictions back into one predictions file per job, one streamed pass for all jobs
+# Input:
+#   prediction_file: Predictions for union of every job's peptides
+#   jobs: Job dictionaries with keys (int64 peptide keys of job) and out (job predictions csv)
+#   chunk_size: Prediction rows read at a time
+# Output: Dictionary of job name:{predictions, binders} row counts
+def split_batch(prediction_file, jobs, chunk_size=1000000):
+    counts = {job["name"]: {"predictions": 0, "binders": 0} for job in jobs}
+    first_chunk = True
+    for chunk in pd.read_csv(prediction_file, chunksize=chunk_size, dtype={"peptide": str}):
+        keys = encode_peptides(chunk["peptide"])
+        for job in jobs:
+            job_rows = chunk[np.isin(keys, job["keys"])]
+            job_rows.to_csv(job["out"], mode="w" if first_chunk else "a", header=first_chunk, index=False)
+            counts[job["name"]]["predictions"] += len(job_rows)
+            counts[job["name"]]["binders"] += int((job_rows["mhcflurry_affinity"] <= 500).sum())
+        first_chunk = False
+    return counts
+
+
+# Method: run_batch
+# Goal: Run many FASTA x fragment size jobs in one invocation
+#   Allele tables and supported list are loaded once, peptides are deduplicated across all jobs
+#   and predicted in one shared work queue, then split back per job
+# Input: Command line arguments (--batch manifest, --out_dir and prediction settings)
+# Output: Location of summary csv
+def run_batch(args):
+    out_dir = args.out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = read_batch(args.batch)
+    # Allele data once for every job
+    with stage("grab_mhc"):
+        hlas, hlas_inverse, hlas_freq = grab_mhc(hla_file_list(args), 50.0)
+        alleles, unsupported_alleles = select_alleles(hlas, load_supported())
+    # Peptide index per job, union of unique peptides shared by all jobs
+    for job in jobs:
+        with stage("fragment " + job["name"]):
+            peptide_index = build_peptide_index(stream_fragment_keys(stream_seq(job["fasta"]),
+                                                                     [size + 1 for size in job["sizes"]]))
+            count_index(peptide_index)
+        job["keys"] = peptide_index["keys"]
+        job["out"] = os.path.join(out_dir, job["name"] + "_predictions.csv")
+        job["proteins"] = len(peptide_index["proteins"])
+        job["fragments"] = len(peptide_index["position"])
+        write_occurrences(peptide_index, os.path.splitext(job["out"])[0] + "_occurrences.csv")
+        print(job["name"] + " - Unique peptides: " + str(len(job["keys"])) + " Duplication factor: "
+              + str(round(duplication_factor(peptide_index), 3)))
+    shared_keys = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + [job["keys"] for job in jobs]))
+    print("Unique peptides across batch: " + str(len(shared_keys)) + " (job total: "
+          + str(sum(len(job["keys"]) for job in jobs)) + ")")
+    print("Running MHCflurry...")
+    with stage("predict"):
+        shared_predictions = predict_alleles(decode_keys(shared_keys), alleles,
+                                             os.path.join(out_dir, "batch_predictions.csv"), args.chunk_size,
+                                             args.processes, args.retries, args.predictor, args.cache,
+                                             args.cache_version, args.cache_max, args.backend, args.models_dir)
+    with stage("split"):
+        counts = split_batch(shared_predictions, jobs)
+        count("binders", sum(job_counts["binders"] for job_counts in counts.values()))
+    os.remove(shared_predictions)
+    summary = pd.DataFrame([{"name": job["name"], "fasta": job["fasta"],
+                             "sizes": " ".join(str(size) for size in job["sizes"]), "proteins": job["proteins"],
+                             "fragments": job["fragments"], "unique_peptides": len(job["keys"]),
+                             "alleles": len(alleles), "predictions": counts[job["name"]]["predictions"],
+                             "binders_500nM": counts[job["name"]]["binders"], "results": job["out"]}
+                            for job in jobs])
+    summary_location = os.path.join(out_dir, "batch_summary.csv")
+    summary.to_csv(summary_location, index=False)
+    for allele in unsupported_alleles:
+        print("Allele not found: " + allele + " Population: " + ", ".join(hlas_inverse[allele]))
+    return summary_location
+
+
 # Method: parse_args
 # Goal: Collect command line arguments from user
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("fasta", help="Fasta file in containing protein sequences", type=str)
-    parser.add_argument("-s", "--size", help="Sizes of fragment", type=int)
+    parser.add_argument("fasta", help="Fasta file in containing protein sequences (.gz accepted)", type=str,
+                        nargs="?")
+    parser.add_argument("-s", "--size", help="Sizes of fragment, several may be given", type=int, nargs="+")
     parser.add_argument("-a", help="HLA-A", type=str)
     parser.add_argument("-b", help="HLA-B", type=str)
     parser.add_argument("-c", help="HLA-C", type=str)
-    return parser.parse_args()
+    parser.add_argument("-o", "--out", help="MHCflurry output csv, defaults to predictions.csv (in run directory "
+                                            "if --run_dir is given)", type=str)
+    parser.add_argument("--batch", help="Batch manifest csv (name,fasta,sizes) - every job in one invocation",
+                        type=str)
+    parser.add_argument("--out_dir", help="Output directory for --batch", type=str, default="batch_results")
+    parser.add_argument("--run_dir", help="Run as checkpointed stages, artifacts and manifest kept here", type=str)
+    parser.add_argument("--resume", help="Skip stages and prediction chunks finished by an earlier run in --run_dir",
+                        action="store_true", default=False)
+    parser.add_argument("--chunk_size", help="Peptides per MHCflurry work unit", type=int, default=5000)
+    parser.add_argument("-p", "--processes", help="Number of MHCflurry processes run at once", type=int, default=1)
+    parser.add_argument("--retries", help="Extra attempts for a failed work unit", type=int, default=2)
+    parser.add_argument("--predictor", help="MHCflurry predict executable", type=str, default="mhcflurry-predict")
+    parser.add_argument("--cache", help="SQLite prediction cache, only new allele/peptide pairs are predicted, "
+                                        "output keeps allele, peptide and affinity columns only", type=str)
+    parser.add_argument("--cache_version", help="Predictor version key for cached predictions, defaults to backend, "
+                                                "installed MHCflurry release and models", type=str)
+    parser.add_argument("--cache_max", help="Maximum number of cached predictions", type=int)
+    parser.add_argument("--backend", help="Predictor backend", type=str, choices=backends, default="cli")
+    parser.add_argument("--models_dir", help="MHCflurry models directory for inprocess backend", type=str)
+    parser.add_argument("--report", help="Per-stage run report, JSON (.ndjson for one line per stage)", type=str)
+    parser.add_argument("--profile", help="cProfile dump of run", type=str)
+    args = parser.parse_args(argv)
+    if args.batch is None and (args.fasta is None or args.size is None):
+        parser.error("fasta and -s/--size are required unless --batch is given")
+    # Fragments are -s + 1 long and packed into int64 keys of at most max_length residues
+    if args.size is not None and any(size + 1 > max_length for size in args.size):
+        parser.error("-s/--size must be at most " + str(max_length - 1))
+    return args
 
 
-# Method: main
-# Goal: Control the operation of program
-def main():
-    args = parse_args()
-    all_seqs = grab_all_seq(args.fasta)  # Grab all protein sequences and ids
-    fragments = fragment(all_seqs, args.size + 1)  # produce fragment size selected
-    hla_files = []
-    if args.a:
-        hla_files.append(args.a)
-    if args.b:
-        hla_files.append(args.b)
-    if args.c:
-        hla_files.append(args.c)
-    hlas = grab_mhc(hla_files)
-    # Supported HLA List
-    supported_alleles = []
-    with open("supported_alleles.txt", "r") as f:
-        for line in f:
-            supported_alleles.append(line[:-1])
-    # Remove redundant HLAs
-    hlas_submit = hlas  # Copy of hlas but with removed redundancy
-    long_hla_list = []
-    for population in hlas_submit:
-        for allele in hlas_submit[population]:
-            if allele in long_hla_list:
-                hlas_submit[population].remove(allele)
-            else:
-                long_hla_list.append(allele)
+# Method: run
+# Goal: Run pipeline for parsed command line arguments
+def run(args):
+    if args.batch is not None:
+        summary_location = run_batch(args)
+        print("Summary: " + summary_location)
+        print("Done!")
+        return
+    if args.out is None:
+        args.out = "predictions.csv" if args.run_dir is None else os.path.join(args.run_dir, "predictions.csv")
+    if args.run_dir is not None:
+        results_final, occurrences_final = run_staged(args)
+        print("Results: " + results_final)
+        print("Peptide occurrences: " + occurrences_final)
+        print("Done!")
+        return
+    with stage("fragment"):
+        all_seqs = stream_seq(args.fasta)  # Stream protein sequences and ids
+        # produce fragment sizes selected, encoded as int64 keys
+        fragments = stream_fragment_keys(all_seqs, [size + 1 for size in args.size])
+        peptide_index = build_peptide_index(fragments)  # Unique peptide keys with (ID, Position) occurrences
+        count_index(peptide_index)
+    print("Unique peptides: " + str(len(peptide_index["keys"])) + " Duplication factor: "
+          + str(round(duplication_factor(peptide_index), 3)))
+    with stage("grab_mhc"):
+        hla_files = hla_file_list(args)
+        # Population:Allele List, normalised and without repeats
+        hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files, 50.0)
+        # Supported HLA Set
+        supported_alleles = load_supported()
     print("Running MHCflurry...")
-    results_final, unsupported_alleles = run_mhcflurry(fragments, hlas_submit, supported_alleles)
-    for population in hlas_submit:
-        for allele in hlas_submit[population]:
-            if allele[-1].isnumeric():
-                allele = allele[:-1]
-            if allele in unsupported_alleles:
-                print("Allele not found: " + allele + " Population: " + population[:-5])
+    with stage("predict"):
+        results_final, unsupported_alleles = run_mhcflurry(index_peptides(peptide_index), hlas, supported_alleles,
+                                                           args.out, args.chunk_size, args.processes, args.retries,
+                                                           args.predictor, args.cache, args.cache_version,
+                                                           args.cache_max, args.backend, args.models_dir)
+    with stage("occurrences"):
+        # Provenance of each unique peptide, join back with peptide_index.join_occurrences
+        occurrences_final = write_occurrences(peptide_index,
+                                              os.path.splitext(results_final)[0] + "_occurrences.csv")
+    for allele in unsupported_alleles:
+        print("Allele not found: " + allele + " Population: " + ", ".join(hlas_inverse[allele]))
     print("Results: " + results_final)
+    print("Peptide occurrences: " + occurrences_final)
     print("Done!")
 
 
+# Method: main
+# Goal: Control the operation of program
+# Input: Command line arguments, None for sys.argv (daemon passes client arguments)
+def main(argv=None):
+    args = parse_args(argv)
+    with run_report("fragment_to_infinity", argv, args.report, args.profile):
+        run(args)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,108 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+# GLOBAL #
+# Workbook:(mtime, size, DataFrame), tables stay loaded for life of process (ex. mhc_daemon)
+loaded_tables = {}
+
+
+# Method: cache_location
+# Goal: Location of columnar cache kept next to workbook, ex. HLA_Class_1/A.xlsx -> HLA_Class_1/A.xlsx.cache.npz
+def cache_location(xlsx_file):
+    return xlsx_file + ".cache.npz"
+
+
+# Method: file_hash
+# Goal: SHA-256 of workbook, used when mtime changed but content may not have
+def file_hash(xlsx_file):
+    sha = hashlib.sha256()
+    with open(xlsx_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# Method: write_cache
+# Goal: Store every workbook column as a NumPy array with file stamp for invalidation
+# Input:
+#   df: DataFrame read from workbook
+#   xlsx_file: Workbook location
+#   stamp: Dictionary of mtime, size and hash of workbook
+def write_cache(df, xlsx_file, stamp):
+    arrays = {"__columns__": np.array(df.columns.tolist(), dtype=str),
+              "__mtime__": np.array(stamp["mtime"]), "__size__": np.array(stamp["size"]),
+              "__hash__": np.array(stamp["hash"])}
+    for position, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays["column_" + str(position)] = values
+    # Write then rename, readers never see a half written cache
+    tmp_location = cache_location(xlsx_file) + "." + str(os.getpid()) + ".tmp.npz"
+    np.savez(tmp_location, **arrays)
+    os.replace(tmp_location, cache_location(xlsx_file))
+
+
+# Method: read_cache
+# Goal: Load workbook columns back from cache if it still matches the workbook
+# Input:
+#   xlsx_file: Workbook location
+#   stamp: Dictionary of mtime and size of workbook
+# Output:
+#   df: DataFrame, or None if cache missing or stale
+#   restamp: True if content matched by hash only, cache should be rewritten with new mtime
+def read_cache(xlsx_file, stamp):
+    if not os.path.exists(cache_location(xlsx_file)):
+        return None, False
+    restamp = False
+    with np.load(cache_location(xlsx_file), allow_pickle=False) as cached:
+        if cached["__mtime__"] != stamp["mtime"] or cached["__size__"] != stamp["size"]:
+            # Touched or copied but maybe unchanged, fall back to content hash
+            if str(cached["__hash__"]) != file_hash(xlsx_file):
+                return None, False
+            restamp = True
+        columns = cached["__columns__"].tolist()
+        df = pd.DataFrame({column: cached["column_" + str(position)] for position, column in enumerate(columns)})
+    return df, restamp
+
+
+# Method: load_table
+# Goal: Be The Match haplotype frequency table, Excel is only parsed the first time or when workbook changes
+#   Held in memory after first load, a changed workbook is read again
+# Input: XLSX file from Be The Match Registry Haplotype Frequencies Tables
+# Output: DataFrame of allele column plus every _freq and _rank column
+def load_table(xlsx_file):
+    info = os.stat(xlsx_file)
+    stamp = {"mtime": info.st_mtime_ns, "size": info.st_size}
+    key = os.path.abspath(xlsx_file)
+    if key in loaded_tables and loaded_tables[key][:2] == (stamp["mtime"], stamp["size"]):
+        return loaded_tables[key][2]
+    df, restamp = read_cache(xlsx_file, stamp)
+    if df is None or restamp:
+        if df is None:
+            df = pd.read_excel(xlsx_file, engine='openpyxl')
+        stamp["hash"] = file_hash(xlsx_file)
+        try:
+            write_cache(df, xlsx_file, stamp)
+        except OSError:
+            print("Could not write cache for: " + xlsx_file)
+    loaded_tables[key] = (stamp["mtime"], stamp["size"], df)
+    return df
+
+
+# Method: top_ranked
+# Goal: Alleles and frequencies at or above rank cutoff for one population, any cutoff served from same table
+# Input:
+#   df: Table from load_table
+#   locus: Allele column name, ex. A
+#   population: Population code, ex. CAU
+#   rank_cutoff: Highest rank kept
+# Output: Lists of alleles and their frequency in population
+def top_ranked(df, locus, population, rank_cutoff):
+    df_top = df[df[population + "_rank"] <= rank_cutoff]
+    return df_top[locus].values.tolist(), df_top[population + "_freq"].values.tolist()
@@ -1,12 +1,14 @@
 # Author: Austin Seamann
 # Version: 1.0
 # Last Updated: December 10th, 2021
-import seaborn as sns
-from matplotlib import pyplot as plt
-import matplotlib.ticker as ticker
 import argparse
+import numpy as np
 import pandas as pd
 import os
+from allele_registry import grab_mhc
+from binder_index import build_binder_index, coverage_table, load_binder_index, minimum_peptide_set, \
+    save_binder_index
+from run_report import count, run_report, stage
 
 
 # GLOBAL #
@@ -20,130 +22,189 @@ codes = {"Race": ["AAFA", "AFB", "AINDI", "AISC", "ALANAM", "AMIND", "CARB", "CA
 code_used = codes["Broad_race"]
 
 
+# Method: population_frame
+# Goal: Allele to population/frequency table for populations in code_used, one row per allele x population
+# Input:
+#   hla_inverse: Allele:Population List
+#   hlas_freq: Allele:{Population:freq}, None leaves Freq_in_Population empty
+# Output: DataFrame of hla, Population, Freq_in_Population, Allele_ID
+def population_frame(hla_inverse, hlas_freq=None):
+    global code_used
+    hlas = []
+    populations = []
+    freqs = []
+    for hla in hla_inverse:
+        for hla_population in hla_inverse[hla]:
+            if hla_population in code_used:
+                hlas.append(hla)
+                populations.append(hla_population)
+                freqs.append(hlas_freq[hla][hla_population] if hlas_freq is not None else float("nan"))
+    population_df = pd.DataFrame({"hla": hlas, "Population": populations, "Freq_in_Population": freqs})
+    population_df["Allele_ID"] = population_df["hla"] + "_" + population_df["Population"]
+    return population_df
+
+
+# Method: read_predictions
+# Goal: Stream MHCFlurry output in chunks, keeping only needed columns and rows at or better than cutoff
+#   Memory scales with number of binders kept, not number of predictions in file
+# Input:
+#   prediction_file: MHCFlurry raw output file (.gz etc. accepted)
+#   affinity: Cutoff on column, None keeps every row
+#   chunk_size: Rows parsed at a time
+#   column: Column cutoff applies to, mhcflurry_affinity (nM) or mhcflurry_affinity_percentile
+# Output: DataFrame of allele, peptide and column
+def read_predictions(prediction_file, affinity=None, chunk_size=1000000, column="mhcflurry_affinity"):
+    kept = []
+    for chunk in pd.read_csv(prediction_file, usecols=["allele", "peptide", column],
+                             dtype={"allele": "category", "peptide": str, column: "float64"},
+                             chunksize=chunk_size):
+        count("predictions_read", len(chunk))
+        if affinity is not None:
+            chunk = chunk[chunk[column] <= affinity]
+        kept.append(chunk)
+    if len(kept) == 0:
+        return pd.DataFrame({"allele": pd.Series(dtype=str), "peptide": pd.Series(dtype=str),
+                             column: pd.Series(dtype="float64")})
+    # Chunks may see different alleles, union categories so concat keeps allele categorical
+    alleles = pd.api.types.union_categoricals([chunk["allele"] for chunk in kept]).categories
+    for chunk in kept:
+        chunk["allele"] = chunk["allele"].cat.set_categories(alleles)
+    return pd.concat(kept, ignore_index=True)
+
+
 # Method: process_file
-# Goal: Generate working file for generating plots - Incorporate additional information to MHCFlurry output
+# Goal: Incorporate population information into MHCFlurry output - in memory, no working file written
 # Input:
-#   prediction_file: MHCFlurry raw output file
-#   new_name: Name of the newly processed file
+#   prediction_file: MHCFlurry raw output file (or DataFrame already read, ex. from read_predictions)
 #   hla_inverse: Allele:Population List
 #   hlas_freq: Allele:{Population:freq}
-# Output: Produces processed file for later analysis
-def process_file(prediction_file, new_name, hla_inverse, hlas_freq="..."):
+# Output: DataFrame of MHCFlurry output with Population, Freq_in_Population and Allele_ID columns,
+#   prediction rows repeated once per population the HLA is ranked in
+def process_file(prediction_file, hla_inverse, hlas_freq=None):
+    if isinstance(prediction_file, str):
+        predictions = read_predictions(prediction_file)
+    else:
+        predictions = prediction_file
+    # HLA-A*02:01 -> A*02:01, split once per distinct allele instead of per row
+    alleles = predictions["allele"].astype(str).unique()
+    hla_of = pd.Series([allele.split("-")[1] for allele in alleles], index=alleles)
+    predictions = predictions.assign(hla=predictions["allele"].astype(str).map(hla_of))
+    # Adding multiple rows if HLA is in several populations
+    processed = predictions.merge(population_frame(hla_inverse, hlas_freq), on="hla", how="inner")
+    return processed.drop(columns="hla")
+
+
+# Method: binders
+# Goal: Keep processed rows with affinity at or better than cutoff, shared by every plot
+# Input:
+#   processed: DataFrame from process_file
+#   affinity: Affinity cutoff in nM
+# Output: DataFrame of binding rows
+def binders(processed, affinity=500):
+    return processed[processed["mhcflurry_affinity"] <= affinity]
+
+
+# Method: population_counts
+# Goal: Number of binding rows and median affinity per population, populations in code_used order
+# Input: DataFrame from binders
+# Output: DataFrame indexed by Population with count and median columns
+def population_counts(binder_df):
     global code_used
-    first_line = True
-    # Updated csv to include Population column
-    with open(new_name, "w") as out_file:
-        with open(prediction_file, "r") as in_file:
-            for line in in_file:
-                if first_line:
-                    # New header
-                    out_file.write(line[:-1] + ",Population,Freq_in_Population,Allele_ID\n")
-                    first_line = False
-                else:
-                    # Process each row
-                    hla = line.split(",")[0].split("-")[1]
-                    if hla in hla_inverse.keys():
-                        new_line = line[:-1]
-                        # Adding multiple lines if HLA is in several populations
-                        for hla_population in hla_inverse[hla]:
-                            if hla_population in code_used:
-                                out_file.write(new_line + "," + hla_population + ","
-                                               + str(hlas_freq[hla][hla_population]) + ","
-                                               + str(hla + "_" + hla_population) + "\n")
+    grouped = binder_df.groupby("Population")["mhcflurry_affinity"].agg(["size", "median"])
+    grouped = grouped.rename(columns={"size": "count"})
+    return grouped.reindex([population for population in code_used if population in grouped.index])
+
+
+# Method: allele_id_counts
+# Goal: Unique binding peptides and frequency per allele/population pair in one grouped pass
+# Input: DataFrame from binders (processed with hlas_freq)
+# Output: DataFrame indexed by Allele_ID with count, freq and Population columns
+def allele_id_counts(binder_df):
+    return binder_df.groupby("Allele_ID", sort=True).agg(count=("peptide", "nunique"),
+                                                         freq=("Freq_in_Population", "first"),
+                                                         Population=("Population", "first"))
+
+
+# Method: weighted_scores
+# Goal: Weighted binder score for every allele/population pair
+#   Weighted_Value = number of unique binding peptides x allele frequency in population
+# Input: DataFrame from binders (processed with hlas_freq), or counts from allele_id_counts
+# Output: DataFrame of Allele_ID, Allele, Population, Weighted_Value sorted by Population
+def weighted_scores(binder_df):
+    grouped = binder_df if "count" in binder_df.columns else allele_id_counts(binder_df)
+    scores = pd.DataFrame({"Allele_ID": grouped.index,
+                           "Allele": grouped.index.str.split("_").str[0],
+                           "Population": grouped["Population"].values,
+                           "Weighted_Value": grouped["count"].values * grouped["freq"].values})
+    return scores.sort_values("Population", kind="stable").reset_index(drop=True)
+
+
+# Method: plotting
+# Goal: Import plotting libraries the first time a figure is requested, runs without plots never pay for them
+# Output: seaborn, matplotlib.pyplot and matplotlib.ticker modules
+def plotting():
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+    import matplotlib.ticker as ticker
+    return sns, plt, ticker
+
+
+# Method: finish_plot
+# Goal: Save or show current plot, then clear it so the next plot starts on a fresh figure
+def finish_plot(save):
+    sns, plt, ticker = plotting()
+    if save != "...":
+        plt.savefig(save, dpi=300)
+    else:
+        plt.show()
+    plt.close("all")
 
 
 # Method: box_plot
 # Goal: Generate box plot for non-weighted number of binders per each HLA
-def box_plot(prediction_file, hla_inverse, save, width_, height_):
-    new_name = prediction_file[:-4] + "_tmp.csv"
-    # Process file to add back repeated HLAs per population removed prior
-    process_file(prediction_file, new_name, hla_inverse)
-    # Grab data needed for plot
-    csv_in = pd.read_csv(new_name).sort_values("Population")
-    csv_in = csv_in[csv_in["mhcflurry_affinity"] <= 500].sort_values("Population")
+# Input: binder_df: DataFrame from binders
+def box_plot(binder_df, save, width_, height_):
+    sns, plt, ticker = plotting()
+    csv_in = binder_df.sort_values("Population", kind="stable")
     # Create boxplot
     sns.set(rc={"figure.figsize": (width_, height_)})
     ax = sns.boxplot(x="Population", y="mhcflurry_affinity", data=csv_in)
-    # Collect data for number of high binders
-    medians = csv_in.groupby(['Population'])['mhcflurry_affinity'].median().values
-    count_values = csv_in['Population'].value_counts().values
-    count_values = [str(x) for x in count_values.tolist()]
-    count_values = ["n: " + i for i in count_values]
+    # Collect data for number of high binders, same order as boxes
+    counts = population_counts(binder_df).sort_index()
+    medians = counts["median"].values
+    count_values = ["n: " + str(x) for x in counts["count"].tolist()]
     pos = range(len(count_values))
     # Add number of high binders to each population
     for tick, label in zip(pos, ax.get_xticklabels()):
         ax.text(pos[tick], medians[tick] + 0.03, count_values[tick], horizontalalignment='center',
                 size='x-small', color='b', weight='semibold')
-    if save != "...":
-        plt.savefig(save, dpi=300)
-    else:
-        plt.show()
+    finish_plot(save)
 
 
 # Method: box_plot_freq
 # Goal: Generate box plot based on weighted HLA frequency binder score
-def box_plot_freq(prediction_file, hla_inverse, hlas_freq, save, width_, height_):
-    global code_used
-    new_name = prediction_file[:-4] + "_tmp.csv"
-    # Process file to add back repeated HLAs per population removed prior
-    process_file(prediction_file, new_name, hla_inverse, hlas_freq)
-    # Grab data needed for plot
-    csv_in = pd.read_csv(new_name)
-    affinity = 500
-    csv_in = csv_in[csv_in["mhcflurry_affinity"] <= affinity].sort_values("Allele_ID")
-    with open("tmp.csv", "w") as f:
-        f.write("Allele_ID,Allele,Population,Weighted_Value\n")
-        for allele_id in csv_in['Allele_ID'].unique():
-            # Get allele_id specific dataframe
-            allele_id_df = csv_in[csv_in["Allele_ID"] == allele_id]
-            # Collect count of allele detection of peptides
-            # Number of unique peptides in list
-            count_allele_id = allele_id_df["peptide"].nunique()
-            # Collect freq information
-            single_row = allele_id_df.iloc[0]
-            freq_allele = single_row['Freq_in_Population']
-            # Calculated weighted score
-            weighted_score = count_allele_id * freq_allele
-            # Other info
-            population = allele_id.split("_")[1]
-            allele = allele_id.split("_")[0]
-            f.write(allele_id + "," + allele + "," + population + "," + str(weighted_score) + "\n")
-    csv_in = pd.read_csv("tmp.csv")
-    csv_in = csv_in.sort_values("Population")
+# Input: scores: DataFrame from weighted_scores
+def box_plot_freq(scores, save, width_, height_, affinity=500):
+    sns, plt, ticker = plotting()
     # Create boxplot
     sns.set(rc={"figure.figsize": (width_, height_)})
     title_ = "HLA binders in " + str(affinity) + "nM or better"
     # Create plot
     sns.set_style("white")
-    ax = sns.boxplot(data=csv_in, x="Population", y="Weighted_Value")
+    ax = sns.boxplot(data=scores, x="Population", y="Weighted_Value")
     plt.title(title_, fontsize=20)
     plt.ylabel('Weighted Score', fontsize=20)
     plt.xlabel('Allele Binders by Population', fontsize=20)
     ax.set_yticklabels(ax.get_yticks(), size=15)
-    if save != "...":
-        plt.savefig(save, dpi=300)
-    else:
-        plt.show()
-    os.remove("tmp.csv")
+    finish_plot(save)
 
 
 # Method: Histogram - Test method
-def histogram(prediction_file, hla_inverse, save, width_, height_):
-    global code_used
-    new_name = prediction_file[:-4] + "_tmp.csv"
-    # Process file to add back repeated HLAs per population removed prior
-    process_file(prediction_file, new_name, hla_inverse)
-    # Grab data needed for plot
-    csv_in = pd.read_csv(new_name)
-    affinity = 500
-    csv_in = csv_in[csv_in["mhcflurry_affinity"] <= affinity].sort_values("Population")
+# Input: binder_df: DataFrame from binders
+def histogram(binder_df, save, width_, height_, affinity=500):
+    sns, plt, ticker = plotting()
     # Collect count
-    count_values = csv_in['Population'].value_counts().values
-    population_info = {}  # Population: Count
-    count = 0
-    for population in code_used:
-        population_info[population] = count_values[count]
-        count += 1
+    population_info = population_counts(binder_df)["count"].to_dict()  # Population: Count
     # Create boxplot
     sns.set(rc={"figure.figsize": (width_, height_)})
     title_ = "HLA binders in " + str(affinity) + "nM and below group"
@@ -151,54 +212,27 @@ def histogram(prediction_file, hla_inverse, save, width_, height_):
     plt.title(title_)
     plt.ylabel('Count')
     plt.xlabel('Population')
-    if save != "...":
-        plt.savefig(save, dpi=300)
-    else:
-        plt.show()
+    finish_plot(save)
 
 
 # Method: scatter_freq
 # Goal: Generate scatter plot based on weighted HLA frequency binder score
-def scatter_freq(prediction_file, hla_inverse, hlas_freq, save, width_, height_):
+# Input: scores: DataFrame from weighted_scores
+def scatter_freq(scores, save, width_, height_, affinity=500):
     global code_used
-    new_name = prediction_file[:-4] + "_tmp.csv"
-    # Process file to add back repeated HLAs per population removed prior
-    process_file(prediction_file, new_name, hla_inverse, hlas_freq)
-    # Grab data needed for plot
-    csv_in = pd.read_csv(new_name)
-    affinity = 500
-    csv_in = csv_in[csv_in["mhcflurry_affinity"] <= affinity].sort_values("Allele_ID")
-    with open("tmp.csv", "w") as f:
-        f.write("Allele_ID,Allele,Population,Weighted_Value\n")
-        for allele_id in csv_in['Allele_ID'].unique():
-            # Get allele_id specific dataframe
-            allele_id_df = csv_in[csv_in["Allele_ID"] == allele_id]
-            # Collect count of allele detection of peptides
-            # Number of unique peptides in list
-            count_allele_id = allele_id_df["peptide"].nunique()
-            # Collect freq information
-            single_row = allele_id_df.iloc[0]
-            freq_allele = single_row['Freq_in_Population']
-            # Calculated weighted score
-            weighted_score = count_allele_id * freq_allele
-            # Other info
-            population = allele_id.split("_")[1]
-            allele = allele_id.split("_")[0]
-            f.write(allele_id + "," + allele + "," + population + "," + str(weighted_score) + "\n")
-    csv_in = pd.read_csv("tmp.csv")
-    csv_in = csv_in.sort_values("Population")
+    sns, plt, ticker = plotting()
     # Create boxplot
     sns.set(rc={"figure.figsize": (width_, height_)})
     title_ = "HLA binders in " + str(affinity) + "nM or better"
     # Determine positions for tick marks
-    total_values = len(csv_in.index)
+    total_values = len(scores.index)
     section = total_values / len(code_used)
     positions = [section/2]  # First position in middle of section
     for each in range(1, len(code_used)):
         positions.append(positions[each - 1] + section)
     print(code_used)
     with sns.axes_style("white"):
-        ax = sns.scatterplot(data=csv_in, x="Allele_ID", hue="Population",
+        ax = sns.scatterplot(data=scores, x="Allele_ID", hue="Population",
                              y="Weighted_Value", legend=False)
         ax.set_yticklabels(ax.get_yticks(), size=15)
         ax.set_xticklabels(ax.get_xticks(), size=15)
@@ -207,68 +241,104 @@ def scatter_freq(prediction_file, hla_inverse, hlas_freq, save, width_, height_)
         ax.set_ylabel("Weighted Score", fontsize=20)
         ax.set_xlabel("Allele", fontsize=20)
         ax.set_title(title_, fontsize=20)
-    if save != "...":
-        plt.savefig(save, dpi=300)
-    else:
-        plt.show()
-    os.remove("tmp.csv")
-
-
-# Method: grab_mhc
-# Goal: Generate dictionaries needed for analysis
-# Input: XLSX file from Be The Match Registry Haplotype Frequencies Tables
-# Output:
-#   hlas_info: Population:IDs > rank
-#   hlas_inverse: Allele:Population List
-#   hlas_freq: Allele:{Population:freq}  ex. hlas_freq["C*07:01"]["NAM"]["0.0000003"]
-def grab_mhc(xlsx_files):
-    hlas_info = {}  # Population:IDs > 50 rank
-    hlas_inverse = {}  # Allele:Population List
-    hlas_freq = {}  # Allele:{Population:freq}  ex. hlas_freq["C*07:01"]["NAM"]["0.0000003"]
-    first_file = True
-    rank_headers = []
-    for file_in in xlsx_files:
-        df = pd.read_excel(file_in, engine='openpyxl')
-        if first_file:
-            headers = df.columns  # All headers in file
-            for header in headers:
-                if header.endswith("_rank"):
-                    if header not in rank_headers:
-                        rank_headers.append(header)
-            first_file = False
-        for header in rank_headers:
-            if header not in hlas_info.keys():
-                hlas_info[header] = []
-            # Cutoff for rank of HLAs submitted
-            # May change from rank to a different measure at some point
-            df_top = df[df[header] <= 25.0]
-            # Collect list of HLA IDs
-            hlas_info[header] = hlas_info[header] + df_top[file_in.split('/')[-1].split(".")[0]].values.tolist()
-            # Collect HLA frequency for Population
-            alleles_list = df_top[file_in.split('/')[-1].split(".")[0]].values.tolist()
-            freq_list = df_top[header.split("_")[0] + "_freq"].values.tolist()
-            for position in range(len(alleles_list)):
-                allele = alleles_list[position]
-                # Collect allele listed if not already key
-                if not allele[-1].isnumeric():  # Remove letters at end of HLA id
-                    allele = allele[:-1]
-                if allele not in hlas_freq.keys():
-                    hlas_freq[allele] = {}
-                hlas_freq[allele][header.split("_")[0]] = freq_list[position]
-    # Create hlas_inverse
-    for population in hlas_info:
-        for hla in hlas_info[population]:
-            if not hla[-1].isnumeric():  # Remove letters at end of HLA id
-                hla = hla[:-1]
-            if hla not in hlas_inverse.keys():  # Start new key in dictionary
-                hlas_inverse[hla] = []
-            hlas_inverse[hla].append(population.split("_")[0])
-    return hlas_info, hlas_inverse, hlas_freq
+    finish_plot(save)
+
+
+# Method: sorted_affinities
+# Goal: Sort each allele's values once - every row, and best value per unique peptide
+# Input:
+#   predictions: DataFrame from read_predictions
+#   column: Column swept, mhcflurry_affinity or mhcflurry_affinity_percentile
+# Output: Dictionary of HLA:(sorted values of every row, sorted best value per unique peptide)
+def sorted_affinities(predictions, column="mhcflurry_affinity"):
+    ordered = predictions.assign(allele=predictions["allele"].astype(str)).sort_values(["allele", column],
+                                                                                       kind="stable")
+    best = ordered.drop_duplicates(["allele", "peptide"])  # First row per peptide is its best value
+    allele_values = {}
+    for source, position in [(ordered, 0), (best, 1)]:
+        alleles, starts = np.unique(source["allele"].to_numpy(), return_index=True)
+        values = source[column].to_numpy()
+        ends = np.append(starts[1:], len(values))
+        for allele, start, end in zip(alleles, starts, ends):
+            hla = allele.split("-")[1]
+            if hla not in allele_values:
+                allele_values[hla] = [None, None]
+            allele_values[hla][position] = values[start:end]
+    return allele_values
+
+
+# Method: sweep_table
+# Goal: Binder counts and weighted scores for every allele/population pair at every threshold
+#   Counts come from binary search on sorted values, no re-filtering per threshold
+# Input:
+#   allele_values: Dictionary from sorted_affinities
+#   hla_inverse: Allele:Population List
+#   hlas_freq: Allele:{Population:freq}
+#   thresholds: List of cutoffs (nM or percentile)
+# Output: Tidy DataFrame of Threshold, Allele_ID, Allele, Population, Binders, Unique_Binders, Weighted_Value
+def sweep_table(allele_values, hla_inverse, hlas_freq, thresholds):
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    population_df = population_frame(hla_inverse, hlas_freq)
+    population_df = population_df[population_df["hla"].isin(allele_values.keys())]
+    empty = np.zeros(len(thresholds), dtype=np.int64)
+    binders_at = {hla: np.searchsorted(values[0], thresholds, side="right") for hla, values in allele_values.items()}
+    unique_at = {hla: np.searchsorted(values[1], thresholds, side="right") for hla, values in allele_values.items()}
+    rows = len(population_df)
+    table = pd.DataFrame({
+        "Threshold": np.tile(thresholds, rows),
+        "Allele_ID": np.repeat(population_df["Allele_ID"].to_numpy(), len(thresholds)),
+        "Allele": np.repeat(population_df["hla"].to_numpy(), len(thresholds)),
+        "Population": np.repeat(population_df["Population"].to_numpy(), len(thresholds)),
+        "Binders": np.concatenate([binders_at.get(hla, empty) for hla in population_df["hla"]] or [empty[:0]]),
+        "Unique_Binders": np.concatenate([unique_at.get(hla, empty) for hla in population_df["hla"]] or [empty[:0]])})
+    table["Weighted_Value"] = table["Unique_Binders"] * np.repeat(population_df["Freq_in_Population"].to_numpy(),
+                                                                  len(thresholds))
+    return table.sort_values(["Threshold", "Population", "Allele_ID"], kind="stable").reset_index(drop=True)
+
+
+# Method: sweep_plot
+# Goal: One weighted score box plot panel per threshold
+# Input: table: DataFrame from sweep_table
+def sweep_plot(table, save, width_, height_, unit="nM"):
+    sns, plt, ticker = plotting()
+    sns.set_style("white")
+    grid = sns.catplot(data=table, x="Population", y="Weighted_Value", col="Threshold", kind="box",
+                       col_wrap=min(3, table["Threshold"].nunique()), sharey=False)
+    grid.set_titles("HLA binders in {col_name}" + unit + " or better")
+    grid.set_axis_labels("Allele Binders by Population", "Weighted Score")
+    grid.figure.set_size_inches(width_, height_)
+    finish_plot(save)
+
+
+# Method: plot_location
+# Goal: Name saved plot, several plots in one run each get their own file ex. results_boxF.png
+def plot_location(save, plot_name, several):
+    if save == "..." or not several:
+        return save
+    stem, extension = os.path.splitext(save)
+    return stem + "_" + plot_name + extension
+
+
+# Method: binder_index_for
+# Goal: Load binder bitmap index, building (and saving) it from predictions when missing or older than predictions
+# Input:
+#   prediction_file: MHCFlurry output csv
+#   index_location: Location of .npz binder index, None to build in memory only
+#   chunk_size: Prediction rows read at a time
+# Output: Binder index, see binder_index.build_binder_index
+def binder_index_for(prediction_file, index_location=None, chunk_size=1000000):
+    if index_location is not None and os.path.exists(index_location) \
+            and os.path.getmtime(index_location) >= os.path.getmtime(prediction_file):
+        return load_binder_index(index_location)
+    binder_index = build_binder_index(prediction_file, chunk_size=chunk_size)
+    if index_location is not None:
+        save_binder_index(binder_index, index_location)
+    return binder_index
 
 
 # Method: parse_args
 # Goal: Collect command line arguments from user
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("mhcflurry_csv", help="MHCflurry output csv", type=str)
     parser.add_argument("-a", help="HLA-A XLSX file from Be The Match", type=str)
@@ -279,6 +349,7 @@ def parse_args():
     parser.add_argument("-s", help="Save plot", type=str, default="...")
     parser.add_argument("--width", help="Width of plot area, if saved", type=float, default=11)
     parser.add_argument("--height", help="Height of plot area, if saved", type=float, default=8.5)
+    parser.add_argument("--chunk_size", help="Prediction rows read at a time", type=int, default=1000000)
     parser.add_argument("--box", help="Box plot of prediction percentile vs population", action="store_true",
                         default=False)
     parser.add_argument("--histo", help="Histogram plot of count of 90 percentile vs population", action="store_true",
@@ -287,17 +358,29 @@ def parse_args():
                         default=False)
     parser.add_argument("--boxF", help="Box plot of weighted HLA binder scores", action="store_true",
                         default=False)
-    return parser.parse_args()
+    parser.add_argument("--affinity", help="Affinity cutoff (nM) for binders in plots", type=float, default=500)
+    parser.add_argument("--sweep", help="Binder counts and weighted scores at each of these cutoffs in one pass",
+                        type=float, nargs="+")
+    parser.add_argument("--sweep_by", help="Column --sweep cutoffs apply to", type=str, default="affinity",
+                        choices=["affinity", "percentile"])
+    parser.add_argument("--sweep_out", help="Save --sweep table as csv", type=str)
+    parser.add_argument("--index", help="Binder bitmap index (.npz), built from predictions if missing or stale",
+                        type=str)
+    parser.add_argument("--coverage", help="Population coverage of all binders for every Race and Broad_race group",
+                        action="store_true", default=False)
+    parser.add_argument("--min_set", help="Smallest peptide set covering this percent of each population",
+                        type=float)
+    parser.add_argument("--report", help="Per-stage run report, JSON (.ndjson for one line per stage)", type=str)
+    parser.add_argument("--profile", help="cProfile dump of run", type=str)
+    return parser.parse_args(argv)
 
 
-# Method: main
-# Goal: Control the operation of program
-def main():
-    args = parse_args()
-    # Change race code
+# Method: run
+# Goal: Run analysis for parsed command line arguments
+def run(args):
+    # Change race code, reset every call so a long-lived process does not keep an earlier choice
     global code_used
-    if args.code:
-        code_used = codes["Race"]
+    code_used = codes["Race"] if args.code else codes["Broad_race"]
     # Collect HLA information
     hla_files = []
     if args.a:
@@ -309,20 +392,72 @@ def main():
     # hla - Population:IDs > rank
     # hlas_inverse - Allele:Population List
     # hlas_frq - Allele:{Population:freq}
-    hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files)
-    # Supported HLA List
-    supported_alleles = []
-    with open("supported_alleles.txt", "r") as f:
-        for line in f:
-            supported_alleles.append(line[:-1])
+    with stage("grab_mhc"):
+        hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files, 25.0)
+    if args.index or args.coverage or args.min_set:
+        with stage("binder_index"):
+            binder_index = binder_index_for(args.mhcflurry_csv, args.index, args.chunk_size)
+            count("indexed_peptides", len(binder_index["keys"]))
+        if args.coverage:
+            with stage("coverage"):
+                table = coverage_table(binder_index, hlas_freq, codes["Race"] + codes["Broad_race"])
+            print(table.pivot(index="Population", columns="Threshold", values="Coverage").to_string())
+        if args.min_set:
+            for population in code_used:
+                with stage("min_set " + population):
+                    peptides, coverage = minimum_peptide_set(binder_index, hlas_freq, population, args.min_set / 100)
+                print(population + " (" + str(round(coverage * 100, 2)) + "%, " + str(len(peptides)) + " peptides): "
+                      + " ".join(peptides))
+    plots = [plot_name for plot_name in ["box", "histo", "scatterF", "boxF"] if getattr(args, plot_name)]
+    if args.sweep:
+        # Read once up to loosest cutoff, sort once, answer every cutoff by binary search
+        column = "mhcflurry_affinity" if args.sweep_by == "affinity" else "mhcflurry_affinity_percentile"
+        with stage("sweep"):
+            sweep_predictions = read_predictions(args.mhcflurry_csv, max(args.sweep), args.chunk_size, column)
+            table = sweep_table(sorted_affinities(sweep_predictions, column), hlas_inverse, hlas_freq, args.sweep)
+            table = table[table["Population"].isin(code_used)]
+        if args.sweep_out:
+            table.to_csv(args.sweep_out, index=False)
+            print("Sweep table: " + args.sweep_out)
+        else:
+            print(table.groupby(["Population", "Threshold"])["Weighted_Value"].sum().unstack().to_string())
+        with stage("plot_sweep"):
+            sweep_plot(table, plot_location(args.s, "sweep", len(plots) > 0), args.width, args.height,
+                       "nM" if args.sweep_by == "affinity" else " percentile")
+    if len(plots) == 0:
+        return
+    # Parse, expand to populations and aggregate once for every plot requested
+    affinity = args.affinity
+    with stage("read_predictions"):
+        predictions = read_predictions(args.mhcflurry_csv, affinity, args.chunk_size)  # Binders only, streamed
+    with stage("process_file"):
+        binder_df = binders(process_file(predictions, hlas_inverse, hlas_freq), affinity)
+        count("binders", len(binder_df))
+    if args.scatterF or args.boxF:
+        with stage("weighted_scores"):
+            scores = weighted_scores(binder_df)
+    several = len(plots) > 1
     if args.box:
-        box_plot(args.mhcflurry_csv, hlas_inverse, args.s, args.width, args.height)
+        with stage("plot_box"):
+            box_plot(binder_df, plot_location(args.s, "box", several), args.width, args.height)
     if args.histo:
-        histogram(args.mhcflurry_csv, hlas_inverse, args.s, args.width, args.height)
+        with stage("plot_histo"):
+            histogram(binder_df, plot_location(args.s, "histo", several), args.width, args.height, affinity)
     if args.scatterF:
-        scatter_freq(args.mhcflurry_csv, hlas_inverse, hlas_freq, args.s, args.width, args.height)
+        with stage("plot_scatterF"):
+            scatter_freq(scores, plot_location(args.s, "scatterF", several), args.width, args.height, affinity)
     if args.boxF:
-        box_plot_freq(args.mhcflurry_csv, hlas_inverse, hlas_freq, args.s, args.width, args.height)
+        with stage("plot_boxF"):
+            box_plot_freq(scores, plot_location(args.s, "boxF", several), args.width, args.height, affinity)
+
+
+# Method: main
+# Goal: Control the operation of program
+# Input: Command line arguments, None for sys.argv (daemon passes client arguments)
+def main(argv=None):
+    args = parse_args(argv)
+    with run_report("mhc_analysis", argv, args.report, args.profile):
+        run(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,335 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import argparse
+import contextlib
+import hmac
+import io
+import ipaddress
+import json
+import os
+import secrets
+import sys
+import tempfile
+import time
+import traceback
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# GLOBAL #
+# Scripts a client may run inside the daemon, imported on first use
+scripts = ["fragment_to_infinity", "mhc_analysis", "stream_pipeline"]
+default_port = 8300
+
+# Start time and number of requests served, reported by /status, token every request must carry
+server_state = {"started": time.time(), "requests": 0, "token": None}
+token_header = "X-Daemon-Token"
+
+
+# Method: token_location
+# Goal: Token file of daemon on a port, readable by daemon owner only
+def token_location(port):
+    return os.path.join(os.path.expanduser("~"), ".mhc_daemon_" + str(port) + ".token")
+
+
+# Method: write_token
+# Goal: Write fresh token for this daemon, mode 0600 so other local users cannot read it
+# Output: Token
+def write_token(port):
+    token = secrets.token_hex(32)
+    fd = os.open(token_location(port), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)  # Token file left by an earlier daemon may have other permissions
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+# Method: is_loopback
+# Goal: Whether host address only accepts connections from this machine
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+# Method: run_script
+# Goal: Run one of the pipeline scripts with client's command line arguments inside this process,
+#   so allele tables, supported alleles, loaded models and imported libraries are reused
+# Input:
+#   script: Script name, one of scripts
+#   argv: Command line arguments as given to the script
+#   cwd: Client working directory, relative paths are resolved from it
+# Output: Dictionary of status (exit code), stdout and stderr
+def run_script(script, argv, cwd):
+    if script not in scripts:
+        return {"status": 2, "stdout": "", "stderr": "Unknown script: " + str(script) + "\n"}
+    module = __import__(script)
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 0
+    previous_cwd = os.getcwd()
+    previous_argv = sys.argv
+    try:
+        os.chdir(cwd)
+        sys.argv = [script + ".py"] + list(argv)  # Usage and error messages name the script
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                module.main(argv)
+            except SystemExit as error:  # argparse errors and --help
+                status = error.code if isinstance(error.code, int) else (0 if error.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+    finally:
+        os.chdir(previous_cwd)
+        sys.argv = previous_argv
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+# Method: predict_peptides
+# Goal: Score a list of peptides without FASTA or fragmenting, alleles given or taken from HLA tables
+# Input: Request dictionary holding
+#   peptides: List of peptides
+#   alleles: List of alleles (ex. HLA-A*02:01), or hla_files: XLSX files from Be The Match
+#   backend, predictor, models_dir, cache, cache_version, cache_max, chunk_size, processes: As in
+#   fragment_to_infinity, optional
+# Output: Dictionary of columns and rows of MHCFlurry output, unsupported alleles
+def predict_peptides(request):
+    from allele_registry import grab_mhc, load_supported
+    from fragment_to_infinity import predict_alleles, select_alleles
+    import pandas as pd
+    unsupported_alleles = []
+    alleles = request.get("alleles")
+    if alleles is None:
+        hlas, hlas_inverse, hlas_freq = grab_mhc(request.get("hla_files", []), 50.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            alleles, unsupported_alleles = select_alleles(hlas, load_supported())
+    peptides = list(dict.fromkeys(request["peptides"]))
+    tmp_fd, tmp_location = tempfile.mkstemp(prefix="mhc_daemon_", suffix=".csv")
+    os.close(tmp_fd)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            predict_alleles(peptides, alleles, tmp_location, request.get("chunk_size", 5000),
+                            request.get("processes", 1), request.get("retries", 2),
+                            request.get("predictor", "mhcflurry-predict"), request.get("cache"),
+                            request.get("cache_version"), request.get("cache_max"), request.get("backend", "cli"),
+                            request.get("models_dir"))
+        predictions = pd.read_csv(tmp_location, dtype={"peptide": str})
+    finally:
+        os.remove(tmp_location)
+    return {"columns": predictions.columns.tolist(), "rows": predictions.values.tolist(),
+            "unsupported": unsupported_alleles}
+
+
+# Method: daemon_status
+# Goal: What the daemon holds warm
+def daemon_status():
+    import allele_registry
+    import hla_tables
+    import predictors
+    return {"pid": os.getpid(), "uptime": round(time.time() - server_state["started"], 1),
+            "requests": server_state["requests"], "tables": sorted(hla_tables.loaded_tables),
+            "supported_lists": len(allele_registry.loaded_supported),
+            "models": [str(models_dir) for models_dir in predictors.loaded_models],
+            "scripts": [script for script in scripts if script in sys.modules]}
+
+
+# Class: DaemonHandler
+# Goal: JSON over localhost HTTP - POST /run, POST /predict, GET /status
+#   Served one request at a time, scripts share module globals and working directory
+#   Every request must carry the daemon token, POST bodies must be application/json so a browser page
+#   cannot reach the daemon with a simple cross-site request
+class DaemonHandler(BaseHTTPRequestHandler):
+    def authorized(self):
+        token = self.headers.get(token_header, "")
+        if not hmac.compare_digest(token.encode(), server_state["token"].encode()):
+            self.send_json(403, {"error": "Missing or wrong daemon token"})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path != "/status":
+            self.send_json(404, {"error": "Unknown path: " + self.path})
+            return
+        self.send_json(200, daemon_status())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.headers.get_content_type() != "application/json":
+            self.send_json(415, {"error": "Request must be application/json"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "Request is not JSON"})
+            return
+        server_state["requests"] += 1
+        if self.path == "/run":
+            self.send_json(200, run_script(request.get("script"), request.get("argv", []),
+                                           request.get("cwd", os.getcwd())))
+        elif self.path == "/predict":
+            try:
+                self.send_json(200, predict_peptides(request))
+            except Exception as error:
+                self.send_json(500, {"error": repr(error)})
+        else:
+            self.send_json(404, {"error": "Unknown path: " + self.path})
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(self.address_string() + " " + (format % args), file=sys.stderr)
+
+
+# Method: serve
+# Goal: Start daemon, optionally warming allele tables and predictor before the first request
+# Input:
+#   host, port: Address to listen on, localhost only by default
+#   hla_files: XLSX files to load up front
+#   backend, models_dir: Predictor backend to load up front (inprocess loads model)
+#   allow_remote: Allow host reachable from other machines
+def serve(host="127.0.0.1", port=default_port, hla_files=(), backend=None, models_dir=None, allow_remote=False):
+    if not allow_remote and not is_loopback(host):
+        raise ValueError("Host " + host + " is reachable from other machines, pass allow_remote to serve on it")
+    # Figures are only ever saved from the daemon, never shown
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    from allele_registry import grab_mhc, load_supported
+    load_supported()
+    if len(hla_files) > 0:
+        grab_mhc(list(hla_files), 50.0)
+    if backend == "inprocess":
+        from predictors import load_model
+        load_model(models_dir)
+    server = HTTPServer((host, port), DaemonHandler)
+    server_state["token"] = write_token(port)
+    print("Listening on http://" + host + ":" + str(port) + " Token: " + token_location(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(token_location(port))
+
+
+# Method: call_daemon
+# Goal: Send request to daemon, with token the daemon wrote at start
+# Input:
+#   port: Daemon port
+#   path: /run, /predict or /status
+#   request: Dictionary sent as JSON, None for GET
+# Output: Response dictionary
+def call_daemon(port, path, request=None):
+    try:
+        with open(token_location(port), "r") as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        return {"error": "No daemon token at " + token_location(port) + ", is the daemon running?"}
+    data = None if request is None else json.dumps(request).encode()
+    http_request = urllib.request.Request("http://127.0.0.1:" + str(port) + path, data=data,
+                                          headers={"Content-Type": "application/json", token_header: token})
+    try:
+        with urllib.request.urlopen(http_request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return json.loads(error.read())
+
+
+# Method: read_peptides
+# Goal: Peptides from command line and from file (one per line, FASTA style headers skipped)
+def read_peptides(args):
+    peptides = list(args.peptides)
+    if args.file:
+        with open(args.file, "r") as f:
+            peptides.extend(line.strip() for line in f if line.strip() != "" and not line.startswith(">"))
+    return peptides
+
+
+# Method: parse_args
+# Goal: Collect command line arguments from user
+def parse_args():
+    from predictors import backends
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="Daemon port on localhost", type=int, default=default_port)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Start daemon")
+    serve_parser.add_argument("--host", help="Address to listen on", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--allow_remote", help="Allow a --host reachable from other machines",
+                              action="store_true", default=False)
+    serve_parser.add_argument("-a", help="HLA-A XLSX file to load at start", type=str)
+    serve_parser.add_argument("-b", help="HLA-B XLSX file to load at start", type=str)
+    serve_parser.add_argument("-c", help="HLA-C XLSX file to load at start", type=str)
+    serve_parser.add_argument("--backend", help="Predictor backend to load at start", type=str, choices=backends)
+    serve_parser.add_argument("--models_dir", help="MHCflurry models directory for inprocess backend", type=str)
+    run_parser = commands.add_parser("run", help="Run a script in daemon with its usual arguments")
+    run_parser.add_argument("script", help="Script to run", type=str, choices=scripts)
+    run_parser.add_argument("script_args", help="Arguments for script", nargs=argparse.REMAINDER)
+    predict_parser = commands.add_parser("predict", help="Score a peptide list, MHCflurry csv on stdout")
+    predict_parser.add_argument("peptides", help="Peptides", type=str, nargs="*")
+    predict_parser.add_argument("--file", help="File of peptides, one per line", type=str)
+    predict_parser.add_argument("-a", help="HLA-A XLSX file from Be The Match", type=str)
+    predict_parser.add_argument("-b", help="HLA-B XLSX file from Be The Match", type=str)
+    predict_parser.add_argument("-c", help="HLA-C XLSX file from Be The Match", type=str)
+    predict_parser.add_argument("--alleles", help="Alleles to score instead of HLA tables, ex. HLA-A*02:01",
+                                type=str, nargs="+")
+    predict_parser.add_argument("--backend", help="Predictor backend", type=str, choices=backends, default="cli")
+    predict_parser.add_argument("--predictor", help="MHCflurry predict executable", type=str,
+                                default="mhcflurry-predict")
+    predict_parser.add_argument("--models_dir", help="MHCflurry models directory for inprocess backend", type=str)
+    predict_parser.add_argument("--cache", help="SQLite prediction cache, output keeps allele, peptide and affinity "
+                                                "columns only", type=str)
+    commands.add_parser("status", help="Show what the daemon holds in memory")
+    args = parser.parse_args()
+    if args.command == "serve" and not args.allow_remote and not is_loopback(args.host):
+        parser.error("--host " + args.host + " is reachable from other machines, add --allow_remote to serve on it")
+    return args
+
+
+# Method: main
+# Goal: Control the operation of program
+def main():
+    args = parse_args()
+    hla_files = [os.path.abspath(file_in) for file_in in [getattr(args, "a", None), getattr(args, "b", None),
+                                                          getattr(args, "c", None)] if file_in]
+    if args.command == "serve":
+        serve(args.host, args.port, hla_files, args.backend, args.models_dir, args.allow_remote)
+    elif args.command == "run":
+        response = call_daemon(args.port, "/run", {"script": args.script, "argv": args.script_args,
+                                                   "cwd": os.getcwd()})
+        sys.stdout.write(response.get("stdout", ""))
+        sys.stderr.write(response.get("stderr", response.get("error", "")))
+        sys.exit(response.get("status", 1))
+    elif args.command == "predict":
+        request = {"peptides": read_peptides(args), "backend": args.backend, "predictor": args.predictor,
+                   "models_dir": os.path.abspath(args.models_dir) if args.models_dir else None,
+                   "cache": os.path.abspath(args.cache) if args.cache else None}
+        if args.alleles:
+            request["alleles"] = args.alleles
+        else:
+            request["hla_files"] = hla_files
+        response = call_daemon(args.port, "/predict", request)
+        if "error" in response:
+            sys.exit("Prediction failed: " + response["error"])
+        print(",".join(response["columns"]))
+        for row in response["rows"]:
+            print(",".join(str(value) for value in row))
+        for allele in response["unsupported"]:
+            print("Unsupported allele: HLA-" + allele, file=sys.stderr)
+    else:
+        print(json.dumps(call_daemon(args.port, "/status"), indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from checkpoints import hash_file
+
+
+# Method: write_chunks
+# Goal: Split allele x peptide work into input files MHCFlurry can read, avoids argument length limits
+# Input:
+#   pairs: iterable of (allele, peptide) to predict
+#   chunk_dir: Directory to write chunk input files to
+#   chunk_size: Number of allele,peptide rows per chunk
+# Output: List of chunk input file locations, in order
+def write_chunks(pairs, chunk_dir, chunk_size):
+    chunk_files = []
+    current = []  # Pairs of chunk being collected
+    for pair in pairs:
+        current.append(pair)
+        if len(current) == chunk_size:
+            chunk_files.append(write_chunk(current, chunk_dir, len(chunk_files)))
+            current = []
+    if len(current) > 0:
+        chunk_files.append(write_chunk(current, chunk_dir, len(chunk_files)))
+    return chunk_files
+
+
+# Method: write_chunk
+# Goal: Write single chunk input file with allele,peptide rows
+# Output: Location of chunk input file
+def write_chunk(pairs, chunk_dir, chunk_number):
+    chunk_file = os.path.join(chunk_dir, "chunk_" + str(chunk_number).zfill(6) + ".csv")
+    with open(chunk_file, "w") as f:
+        f.write("allele,peptide\n")
+        for allele, peptide in pairs:
+            f.write(allele + "," + peptide + "\n")
+    return chunk_file
+
+
+# Method: run_chunk
+# Goal: Run predictor on a single chunk, retrying if the predictor fails
+# Input:
+#   chunk_file: Location of chunk input file
+#   predictor: Predictor executable, mhcflurry-predict or compatible stub
+#   retries: Number of additional attempts after a failure
+# Output: Location of chunk output file
+def run_chunk(chunk_file, predictor="mhcflurry-predict", retries=2):
+    # Output is named by hash of chunk input, a resumed run only reuses output of identical pairs
+    #   (with a prediction cache the pairs in each chunk depend on what the cache held at the time)
+    output_location = chunk_file[:-4] + "_" + hash_file(chunk_file)[:16] + "_out.csv"
+    if os.path.exists(output_location):
+        # Finished by an earlier run, output only appears once complete
+        return output_location
+    partial_location = chunk_file[:-4] + "_partial.csv"
+    for attempt in range(retries + 1):
+        result = subprocess.run([predictor, chunk_file, "--out", partial_location],
+                                stdout=subprocess.DEVNULL)
+        if result.returncode == 0 and os.path.exists(partial_location):
+            os.replace(partial_location, output_location)
+            return output_location
+        print("Chunk failed: " + chunk_file + " Attempt: " + str(attempt + 1))
+    raise RuntimeError("Predictor failed on " + chunk_file + " after " + str(retries + 1) + " attempts")
+
+
+# Method: merge_chunks
+# Goal: Combine chunk outputs into one predictions file in chunk order, single header
+# Input:
+#   chunk_outputs: List of chunk output file locations, in order
+#   output_location: Location of merged predictions file
+# Output: Location of merged predictions file
+def merge_chunks(chunk_outputs, output_location):
+    with open(output_location, "w") as out_file:
+        first_file = True
+        for chunk_output in chunk_outputs:
+            with open(chunk_output, "r") as in_file:
+                header = in_file.readline()
+                if first_file:
+                    out_file.write(header)
+                    first_file = False
+                shutil.copyfileobj(in_file, out_file)
+    return output_location
+
+
+# Method: run_chunk_files
+# Goal: Write chunks of (allele, peptide) pairs and run them across a pool of predictor processes
+# Input:
+#   pairs: iterable of (allele, peptide)
+#   chunk_dir: Directory for chunk inputs and outputs, chunks with output already there are not run again
+#   chunk_size, processes, retries, predictor: As in run_pairs
+# Output: List of chunk output file locations, in order
+def run_chunk_files(pairs, chunk_dir, chunk_size=5000, processes=1, retries=2, predictor="mhcflurry-predict"):
+    chunk_files = write_chunks(pairs, chunk_dir, chunk_size)
+    # Each worker only waits on its predictor subprocess, threads are enough to keep the pool busy
+    with ThreadPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(lambda chunk_file: run_chunk(chunk_file, predictor, retries), chunk_files))
+
+
+# Method: run_pairs
+# Goal: Predict (allele, peptide) pairs across a pool of predictor processes
+# Input:
+#   pairs: iterable of (allele, peptide)
+#   output_location: Location of merged predictions file
+#   chunk_size: Number of allele,peptide rows per chunk
+#   processes: Number of predictor processes run at once
+#   retries: Number of additional attempts for failed chunks
+#   predictor: Predictor executable
+#   chunk_dir: Directory kept for chunks so an interrupted run can resume, None for temporary directory
+# Output: Location of merged predictions file
+def run_pairs(pairs, output_location, chunk_size=5000, processes=1, retries=2, predictor="mhcflurry-predict",
+              chunk_dir=None):
+    if chunk_dir is not None:
+        os.makedirs(chunk_dir, exist_ok=True)
+        merge_chunks(run_chunk_files(pairs, chunk_dir, chunk_size, processes, retries, predictor), output_location)
+        return output_location
+    # Chunks live next to output, unique per run so concurrent runs do not clobber each other
+    chunk_dir = tempfile.mkdtemp(prefix="mhcflurry_chunks_", dir=os.path.dirname(os.path.abspath(output_location)))
+    try:
+        merge_chunks(run_chunk_files(pairs, chunk_dir, chunk_size, processes, retries, predictor), output_location)
+    finally:
+        shutil.rmtree(chunk_dir)
+    return output_location
+
+
+# Method: run_chunked
+# Goal: Predict every allele x peptide pair across a pool of predictor processes
+# Input:
+#   peptides: iterable of unique peptides
+#   alleles: list of alleles
+#   output_location: Location of merged predictions file
+#   chunk_size: Number of peptides per chunk, each chunk holds every allele for its peptides
+#   processes: Number of predictor processes run at once
+#   retries: Number of additional attempts for failed chunks
+#   predictor: Predictor executable
+#   chunk_dir: Directory kept for chunks so an interrupted run can resume, None for temporary directory
+# Output: Location of merged predictions file
+def run_chunked(peptides, alleles, output_location, chunk_size=5000, processes=1, retries=2,
+                predictor="mhcflurry-predict", chunk_dir=None):
+    pairs = ((allele, peptide) for peptide in peptides for allele in alleles)
+    return run_pairs(pairs, output_location, chunk_size * max(len(alleles), 1), processes, retries, predictor,
+                     chunk_dir)
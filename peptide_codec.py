@@ -0,0 +1,107 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# GLOBAL #
+# 20 standard amino acids then ambiguous/rare codes, residue codes 1-26 (0 = not an amino acid)
+alphabet = "ACDEFGHIKLMNPQRSTVWYBJOUXZ"
+bits = 5  # Bits per residue, 26 codes fit in 5
+max_length = 12  # 12 x 5 bits = 60 bits, longest peptide packed in int64
+
+# ASCII byte:residue code
+lookup = np.zeros(256, dtype=np.uint8)
+for code, residue in enumerate(alphabet, start=1):
+    lookup[ord(residue)] = code
+    lookup[ord(residue.lower())] = code
+
+# Residue code:ASCII byte, code 0 never decoded
+ascii_of = np.zeros(32, dtype=np.uint8)
+ascii_of[1:len(alphabet) + 1] = np.frombuffer(alphabet.encode(), dtype=np.uint8)
+
+
+# Method: encode_sequence
+# Goal: Protein sequence to array of residue codes, one byte per residue
+# Input: Protein sequence
+# Output: uint8 array of residue codes
+def encode_sequence(seq):
+    return lookup[np.frombuffer(seq.encode("ascii", "replace"), dtype=np.uint8)]
+
+
+# Method: window_keys
+# Goal: Every x-mer of encoded protein packed into an int64 key with one vectorised sliding window
+#   Leading residue code is never 0, so keys of different sizes never collide
+# Input:
+#   codes: uint8 array from encode_sequence
+#   size: Fragment size
+# Output:
+#   keys: int64 array of packed fragments
+#   positions: int64 array of fragment start positions
+#   Fragments containing a residue outside alphabet are dropped
+def window_keys(codes, size):
+    if size > max_length:
+        raise ValueError("Fragment size " + str(size) + " over " + str(max_length) + " does not fit in int64 key")
+    if len(codes) < size:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    windows = sliding_window_view(codes, size).astype(np.int64)
+    shifts = np.arange(size - 1, -1, -1, dtype=np.int64) * bits
+    keys = (windows << shifts).sum(axis=1)
+    positions = np.arange(len(keys), dtype=np.int64)
+    valid = windows.min(axis=1) > 0
+    if not valid.all():
+        return keys[valid], positions[valid]
+    return keys, positions
+
+
+# Method: encode_peptides
+# Goal: Peptide strings (ex. MHCFlurry output) to int64 keys, same packing as window_keys
+# Input: Iterable of peptides
+# Output: int64 array of keys, -1 for peptides that cannot be encoded
+def encode_peptides(peptides):
+    raw = np.asarray(list(peptides), dtype="S")
+    if len(raw) == 0:
+        return np.empty(0, dtype=np.int64)
+    width = raw.dtype.itemsize
+    codes = lookup[raw.view(np.uint8).reshape(len(raw), width)].astype(np.int64)
+    lengths = np.char.str_len(raw)
+    keys = np.zeros(len(raw), dtype=np.int64)
+    for position in range(width):
+        # Shorter peptides are padded with zero bytes, skip padding
+        in_peptide = position < lengths
+        keys = np.where(in_peptide, (keys << bits) | codes[:, position], keys)
+    bad = (lengths > max_length) | ((codes == 0) & (np.arange(width) < lengths[:, None])).any(axis=1)
+    keys[bad] = -1
+    return keys
+
+
+# Method: key_lengths
+# Goal: Number of residues packed in each key
+def key_lengths(keys):
+    lengths = np.zeros(len(keys), dtype=np.int64)
+    remaining = np.asarray(keys, dtype=np.int64).copy()
+    while (remaining > 0).any():
+        lengths += remaining > 0
+        remaining >>= bits
+    return lengths
+
+
+# Method: decode_keys
+# Goal: int64 keys back to peptide strings, only used at output boundary
+# Input: int64 array of keys
+# Output: List of peptides
+def decode_keys(keys):
+    keys = np.asarray(keys, dtype=np.int64)
+    peptides = np.empty(len(keys), dtype=object)
+    lengths = key_lengths(keys)
+    for length in np.unique(lengths):
+        selected = np.nonzero(lengths == length)[0]
+        if length == 0:
+            peptides[selected] = ""  # -1 keys of peptides that could not be encoded
+            continue
+        shifts = np.arange(length - 1, -1, -1, dtype=np.int64) * bits
+        codes = (keys[selected, None] >> shifts) & (2 ** bits - 1)
+        # Fixed width byte strings for every peptide of this length at once
+        raw = np.ascontiguousarray(ascii_of[codes]).view("S" + str(length)).ravel()
+        peptides[selected] = raw.astype(str)
+    return peptides.tolist()
@@ -0,0 +1,123 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import numpy as np
+import pandas as pd
+from peptide_codec import decode_keys, encode_peptides
+
+
+# Method: build_peptide_index
+# Goal: Collapse fragment stream to unique peptides while keeping where each came from, all as NumPy arrays
+# Input: Iterable of (protein ID, keys, positions) from stream_fragment_keys
+# Output: Dictionary holding
+#   keys: int64 array of unique peptide keys, sorted
+#   offsets: occurrences of keys[i] are entries offsets[i] to offsets[i + 1] of protein/position
+#   protein: int32 array, number of protein (index into proteins) per occurrence
+#   position: int32 array, start position per occurrence
+#   proteins: List of protein IDs
+def build_peptide_index(fragment_arrays):
+    proteins = []
+    key_parts = []
+    protein_parts = []
+    position_parts = []
+    for current_id, keys, positions in fragment_arrays:
+        key_parts.append(keys)
+        protein_parts.append(np.full(len(keys), len(proteins), dtype=np.int32))
+        position_parts.append(positions.astype(np.int32))
+        proteins.append(current_id)
+    if len(key_parts) == 0:
+        empty = np.empty(0, dtype=np.int32)
+        return {"keys": np.empty(0, dtype=np.int64), "offsets": np.zeros(1, dtype=np.int64), "protein": empty,
+                "position": empty, "proteins": proteins}
+    all_keys = np.concatenate(key_parts)
+    unique_keys, inverse = np.unique(all_keys, return_inverse=True)
+    # Group occurrences by peptide, stable so occurrences stay in order first seen
+    order = np.argsort(inverse, kind="stable")
+    offsets = np.zeros(len(unique_keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(inverse, minlength=len(unique_keys)), out=offsets[1:])
+    return {"keys": unique_keys, "offsets": offsets, "protein": np.concatenate(protein_parts)[order],
+            "position": np.concatenate(position_parts)[order], "proteins": proteins}
+
+
+# Method: index_peptides
+# Goal: Unique peptides of index as strings, for predictors
+# Input: Peptide index from build_peptide_index
+# Output: List of peptides
+def index_peptides(peptide_index):
+    return decode_keys(peptide_index["keys"])
+
+
+# Method: duplication_factor
+# Goal: Ratio of total fragments to unique peptides - how much prediction work dedup saved
+# Input: Peptide index from build_peptide_index
+# Output: Float, 1.0 when no peptide is repeated
+def duplication_factor(peptide_index):
+    if len(peptide_index["keys"]) == 0:
+        return 1.0
+    return len(peptide_index["position"]) / len(peptide_index["keys"])
+
+
+# Method: occurrences_frame
+# Goal: Flatten peptide index into table with one row per occurrence
+# Input:
+#   peptide_index: Peptide index from build_peptide_index
+#   decode: Decode keys to peptide strings, otherwise keep int64 peptide_key column
+# Output: DataFrame of peptide (or peptide_key), protein_id, position
+def occurrences_frame(peptide_index, decode=True):
+    counts = np.diff(peptide_index["offsets"])
+    proteins = np.array(peptide_index["proteins"], dtype=object)[peptide_index["protein"]]
+    if decode:
+        peptides = np.repeat(np.array(decode_keys(peptide_index["keys"]), dtype=object), counts)
+        return pd.DataFrame({"peptide": peptides, "protein_id": proteins, "position": peptide_index["position"]})
+    return pd.DataFrame({"peptide_key": np.repeat(peptide_index["keys"], counts), "protein_id": proteins,
+                         "position": peptide_index["position"]})
+
+
+# Method: write_occurrences
+# Goal: Save peptide provenance next to predictions so results can be joined back later
+# Input:
+#   peptide_index: Peptide index from build_peptide_index
+#   output_location: Location of csv to write
+# Output: Location of occurrences csv
+def write_occurrences(peptide_index, output_location):
+    occurrences_frame(peptide_index).to_csv(output_location, index=False)
+    return output_location
+
+
+# Method: join_occurrences
+# Goal: Join predictions on unique peptides back to every protein and position the peptide occurs at
+#   Join runs on int64 peptide keys, peptide strings are only kept from predictions
+# Input:
+#   predictions: MHCFlurry output DataFrame (or location of csv) with a peptide column
+#   peptide_index: Peptide index from build_peptide_index, or location of csv from write_occurrences
+# Output: DataFrame of predictions with protein_id and position columns, one row per occurrence
+def join_occurrences(predictions, peptide_index):
+    if isinstance(predictions, str):
+        predictions = pd.read_csv(predictions)
+    if isinstance(peptide_index, str):
+        occurrences = pd.read_csv(peptide_index)
+        occurrences["peptide_key"] = encode_peptides(occurrences.pop("peptide"))
+    else:
+        occurrences = occurrences_frame(peptide_index, decode=False)
+    predictions = predictions.assign(peptide_key=encode_peptides(predictions["peptide"]))
+    return predictions.merge(occurrences, on="peptide_key", how="left").drop(columns="peptide_key")
+
+
+# Method: save_peptide_index
+# Goal: Write peptide index arrays to a single .npz file
+# Input:
+#   peptide_index: Peptide index from build_peptide_index
+#   output_location: Location to write, written as given (no extension added)
+def save_peptide_index(peptide_index, output_location):
+    with open(output_location, "wb") as f:
+        np.savez(f, keys=peptide_index["keys"], offsets=peptide_index["offsets"], protein=peptide_index["protein"],
+                 position=peptide_index["position"], proteins=np.array(peptide_index["proteins"], dtype=str))
+
+
+# Method: load_peptide_index
+# Goal: Read peptide index written by save_peptide_index
+# Output: Peptide index as from build_peptide_index
+def load_peptide_index(file_in):
+    with np.load(file_in, allow_pickle=False) as saved:
+        return {"keys": saved["keys"], "offsets": saved["offsets"], "protein": saved["protein"],
+                "position": saved["position"], "proteins": saved["proteins"].tolist()}
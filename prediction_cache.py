@@ -0,0 +1,224 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import os
+import sqlite3
+import tempfile
+import numpy as np
+import pandas as pd
+from peptide_codec import decode_keys, encode_peptides
+from predictors import predict_pairs
+
+# Columns kept for every cached prediction, in output order
+cache_columns = ["allele", "peptide", "mhcflurry_affinity", "mhcflurry_affinity_percentile"]
+
+# Seconds a run waits for another run writing to the same cache before giving up
+lock_timeout = 600.0
+
+# Missing peptides fetched from cache at a time
+fetch_size = 100000
+
+
+# Method: open_cache
+# Goal: Open (or create) on-disk prediction cache keyed by allele, peptide and predictor version
+#   Peptides are stored as int64 keys from peptide_codec. Write-ahead log, so a run reading the cache
+#   never blocks another run writing to it
+# Input: Location of SQLite cache file
+# Output: sqlite3 connection
+def open_cache(cache_location):
+    connection = sqlite3.connect(cache_location, timeout=lock_timeout)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS predictions (allele TEXT, peptide INTEGER, version TEXT, "
+                       "affinity REAL, percentile REAL, last_used INTEGER, PRIMARY KEY (allele, peptide, version))")
+    connection.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+    connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+    connection.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0), "
+                       "('clock', 0)")
+    connection.commit()
+    return connection
+
+
+# Method: tick
+# Goal: Advance cache clock used to order entries by last use, committed at once
+# Output: New clock value
+def tick(connection):
+    connection.execute("UPDATE stats SET value = value + 1 WHERE name = 'clock'")
+    clock = connection.execute("SELECT value FROM stats WHERE name = 'clock'").fetchone()[0]
+    connection.commit()
+    return clock
+
+
+# Method: cache_stats
+# Goal: Collect lifetime hit/miss/eviction counts and current size of cache
+# Output: Dictionary of stat:value
+def cache_stats(connection):
+    stats = dict(connection.execute("SELECT name, value FROM stats WHERE name != 'clock'").fetchall())
+    stats["entries"] = connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups > 0 else 0.0
+    return stats
+
+
+# Method: load_request
+# Goal: Store requested peptide keys in temporary table so lookups run as joins inside SQLite
+# Input:
+#   connection: Cache connection
+#   peptides: iterable of unique peptides, or int64 array of keys
+def load_request(connection, peptides):
+    if isinstance(peptides, np.ndarray) and peptides.dtype == np.int64:
+        keys = peptides
+    else:
+        keys = encode_peptides(peptides)
+    if (keys < 0).any():
+        raise ValueError("Peptides longer than 12 or with unknown residues cannot be cached")
+    connection.execute("DROP TABLE IF EXISTS temp.request")
+    connection.execute("CREATE TEMP TABLE request (peptide INTEGER PRIMARY KEY)")
+    connection.executemany("INSERT OR IGNORE INTO request VALUES (?)", ((key,) for key in keys.tolist()))
+    connection.commit()
+
+
+# Method: count_hits
+# Goal: Number of requested allele x peptide pairs already in cache
+# Input:
+#   connection: Cache connection with request table loaded
+#   alleles: List of alleles
+#   version: Predictor version key
+# Output: Number of cached pairs
+def count_hits(connection, alleles, version):
+    hits = 0
+    for allele in alleles:
+        hits += connection.execute("SELECT COUNT(*) FROM request r JOIN predictions p ON p.peptide = r.peptide "
+                                   "AND p.allele = ? AND p.version = ?", (allele, version)).fetchone()[0]
+    return hits
+
+
+# Method: missing_pairs
+# Goal: Requested (allele, peptide) pairs not yet in cache, one allele at a time in batches so memory
+#   stays flat however many pairs are missing
+# Input:
+#   connection: Cache connection with request table loaded
+#   alleles: List of alleles
+#   version: Predictor version key
+#   counts: Dictionary, misses is added to as pairs are handed out
+# Output: Generator of (allele, peptide)
+def missing_pairs(connection, alleles, version, counts):
+    for allele in alleles:
+        cursor = connection.execute("SELECT r.peptide FROM request r LEFT JOIN predictions p "
+                                    "ON p.peptide = r.peptide AND p.allele = ? AND p.version = ? "
+                                    "WHERE p.peptide IS NULL", (allele, version))
+        rows = cursor.fetchmany(fetch_size)
+        while len(rows) > 0:
+            counts["misses"] += len(rows)
+            # Decoded only here, predictors take peptide strings
+            for peptide in decode_keys([row[0] for row in rows]):
+                yield allele, peptide
+            rows = cursor.fetchmany(fetch_size)
+
+
+# Method: store_predictions
+# Goal: Add MHCFlurry output file to cache, committed chunk by chunk so other runs are never held up long
+# Input:
+#   connection: Cache connection
+#   prediction_file: MHCFlurry output csv
+#   version: Predictor version key
+#   clock: Cache clock value to mark entries with
+def store_predictions(connection, prediction_file, version, clock):
+    for chunk in pd.read_csv(prediction_file, chunksize=100000, float_precision="round_trip",
+                             usecols=["allele", "peptide", "mhcflurry_affinity", "mhcflurry_affinity_percentile"]):
+        keys = encode_peptides(chunk["peptide"])
+        connection.executemany("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                               zip(chunk["allele"].tolist(), keys.tolist(), [version] * len(keys),
+                                   chunk["mhcflurry_affinity"].tolist(),
+                                   chunk["mhcflurry_affinity_percentile"].tolist(), [clock] * len(keys)))
+        connection.commit()
+
+
+# Method: write_cached
+# Goal: Assemble full predictions file for requested alleles and peptides from cache
+#   Only cache_columns are kept, mhcflurry-predict processing/presentation columns are not cached
+# Input:
+#   connection: Cache connection with request table loaded
+#   alleles: List of alleles
+#   version: Predictor version key
+#   output_location: Location of predictions csv
+#   clock: Cache clock value, marks entries as recently used
+def write_cached(connection, alleles, version, output_location, clock):
+    with open(output_location, "w") as f:
+        f.write(",".join(cache_columns) + "\n")
+        for allele in alleles:
+            rows = connection.execute("SELECT p.peptide, p.affinity, p.percentile FROM request r JOIN predictions p "
+                                      "ON p.peptide = r.peptide AND p.allele = ? AND p.version = ?",
+                                      (allele, version)).fetchall()
+            peptides = decode_keys([row[0] for row in rows])
+            for position in range(len(rows)):
+                f.write(allele + "," + peptides[position] + "," + str(rows[position][1]) + ","
+                        + str(rows[position][2]) + "\n")
+            connection.execute("UPDATE predictions SET last_used = ? WHERE allele = ? AND version = ? "
+                               "AND peptide IN (SELECT peptide FROM request)", (clock, allele, version))
+            connection.commit()
+
+
+# Method: evict
+# Goal: Keep cache under size bound by removing least recently used entries
+# Input:
+#   connection: Cache connection
+#   max_entries: Maximum number of cached predictions, None for unbounded
+# Output: Number of entries removed
+def evict(connection, max_entries):
+    if max_entries is None:
+        return 0
+    entries = connection.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+    if entries <= max_entries:
+        return 0
+    removed = entries - max_entries
+    connection.execute("DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions "
+                       "ORDER BY last_used LIMIT ?)", (removed,))
+    connection.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (removed,))
+    return removed
+
+
+# Method: run_cached
+# Goal: Predict only allele x peptide pairs missing from cache, then assemble full results from cache
+#   No transaction is open while the predictor runs, other runs may use the same cache meanwhile
+# Input:
+#   peptides: iterable of unique peptides
+#   alleles: list of alleles
+#   output_location: Location of predictions csv
+#   cache_location: Location of SQLite cache file
+#   version: Predictor version key, predictions from other versions are never reused
+#   max_entries: Maximum number of cached predictions, None for unbounded
+#   chunk_size: Number of peptides per work unit, as in run_chunked
+#   processes, retries, predictor, backend, models_dir, chunk_dir: Passed to predict_pairs for missing pairs
+# Output: Dictionary of hits and misses for this run
+def run_cached(peptides, alleles, output_location, cache_location, version="mhcflurry-predict", max_entries=None,
+               chunk_size=5000, processes=1, retries=2, predictor="mhcflurry-predict", backend="cli",
+               models_dir=None, chunk_dir=None):
+    alleles = list(dict.fromkeys(alleles))  # Unique, order kept
+    connection = open_cache(cache_location)
+    counts = {"hits": 0, "misses": 0}
+    try:
+        load_request(connection, peptides)
+        counts["hits"] = count_hits(connection, alleles, version)
+        requested = connection.execute("SELECT COUNT(*) FROM request").fetchone()[0] * len(alleles)
+        clock = tick(connection)
+        if counts["hits"] < requested:
+            # Predict missing pairs to a temporary file next to output, then fold into cache
+            tmp_fd, tmp_location = tempfile.mkstemp(prefix="mhcflurry_missing_", suffix=".csv",
+                                                    dir=os.path.dirname(os.path.abspath(output_location)))
+            os.close(tmp_fd)
+            try:
+                if backend == "cli":
+                    chunk_size = chunk_size * max(len(alleles), 1)  # Rows per work unit
+                predict_pairs(missing_pairs(connection, alleles, version, counts), tmp_location, backend, chunk_size,
+                              processes, retries, predictor, models_dir, chunk_dir)
+                store_predictions(connection, tmp_location, version, clock)
+            finally:
+                os.remove(tmp_location)
+        write_cached(connection, alleles, version, output_location, clock)
+        connection.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (counts["hits"],))
+        connection.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (counts["misses"],))
+        evict(connection, max_entries)
+        connection.commit()
+    finally:
+        connection.close()
+    return counts
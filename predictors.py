@@ -0,0 +1,202 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import importlib.metadata
+import os
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+from checkpoints import hash_file
+from mhcflurry_runner import run_chunked, run_pairs
+
+# GLOBAL #
+backends = ["cli", "inprocess", "fake"]
+
+# models_dir:Class1AffinityPredictor, models stay loaded for life of process
+loaded_models = {}
+
+
+# Method: load_model
+# Goal: Load MHCFlurry affinity predictor once per process
+# Input: models_dir: Directory of MHCFlurry models, None for MHCFlurry default download location
+# Output: Class1AffinityPredictor
+def load_model(models_dir=None):
+    if models_dir not in loaded_models:
+        # Import here, TensorFlow is only paid for when the in-process backend is used
+        from mhcflurry import Class1AffinityPredictor
+        loaded_models[models_dir] = Class1AffinityPredictor.load(models_dir)
+    return loaded_models[models_dir]
+
+
+# Method: score_inprocess
+# Goal: Score batch of peptides against one allele with MHCFlurry model held in memory
+# Input:
+#   allele: Allele, ex. HLA-A*02:01
+#   peptides: List of peptides
+#   models_dir: Directory of MHCFlurry models
+# Output: NumPy arrays of affinity (nM) and affinity percentile, in peptide order
+def score_inprocess(allele, peptides, models_dir=None):
+    from mhcflurry.encodable_sequences import EncodableSequences
+    model = load_model(models_dir)
+    encoded = EncodableSequences.create(peptides)  # Encoded once, reused for every network in ensemble
+    affinities = model.predict(encoded, allele=allele)
+    percentiles = model.percentile_ranks(affinities, allele=allele)
+    return np.asarray(affinities, dtype=float), np.asarray(percentiles, dtype=float)
+
+
+# Method: score_fake
+# Goal: Deterministic stand-in for MHCFlurry, same allele and peptide always give same score
+# Input:
+#   allele: Allele
+#   peptides: List of peptides
+#   models_dir: Unused, kept so all scorers share a signature
+# Output: NumPy arrays of affinity (1 - 50000 nM, log-uniform) and affinity percentile
+def score_fake(allele, peptides, models_dir=None):
+    allele_seed = zlib.crc32(allele.encode())
+    uniform = np.array([zlib.crc32(peptide.encode(), allele_seed) for peptide in peptides],
+                       dtype=float) / 2 ** 32
+    return 50000.0 ** uniform, uniform * 100
+
+
+scorers = {"inprocess": score_inprocess, "fake": score_fake}
+
+
+# Method: write_scores
+# Goal: Append scored batch to predictions file
+def write_scores(out_file, allele, peptides, affinities, percentiles):
+    for position in range(len(peptides)):
+        out_file.write(allele + "," + peptides[position] + "," + str(affinities[position]) + ","
+                       + str(percentiles[position]) + "\n")
+
+
+# Method: score_pairs
+# Goal: Score (allele, peptide) pairs in per-allele batches with an in-process scorer
+# Input:
+#   pairs: iterable of (allele, peptide), runs of same allele are batched together
+#   output_location: Location of predictions csv
+#   backend: Name of in-process scorer, "inprocess" or "fake"
+#   batch_size: Maximum peptides scored at once
+#   models_dir: Directory of MHCFlurry models
+# Output: Location of predictions csv
+def score_pairs(pairs, output_location, backend, batch_size=5000, models_dir=None):
+    scorer = scorers[backend]
+    with open(output_location, "w") as out_file:
+        out_file.write("allele,peptide,mhcflurry_affinity,mhcflurry_affinity_percentile\n")
+        current_allele = None
+        batch = []  # Peptides for current allele
+        for allele, peptide in pairs:
+            if allele != current_allele or len(batch) == batch_size:
+                if len(batch) > 0:
+                    write_scores(out_file, current_allele, batch, *scorer(current_allele, batch, models_dir))
+                current_allele = allele
+                batch = []
+            batch.append(peptide)
+        if len(batch) > 0:
+            write_scores(out_file, current_allele, batch, *scorer(current_allele, batch, models_dir))
+    return output_location
+
+
+# Method: predict_pairs
+# Goal: Predict (allele, peptide) pairs with selected backend
+# Input:
+#   pairs: iterable of (allele, peptide)
+#   output_location: Location of predictions csv
+#   backend: "cli" (mhcflurry-predict subprocesses), "inprocess" (model loaded once) or "fake"
+#   chunk_size: Rows per work unit (cli) or peptides per batch (in-process)
+#   processes, retries, predictor: Passed to run_pairs for cli backend
+#   models_dir: Directory of MHCFlurry models for in-process backend
+#   chunk_dir: Directory kept for cli chunks so an interrupted run can resume
+# Output: Location of predictions csv
+def predict_pairs(pairs, output_location, backend="cli", chunk_size=5000, processes=1, retries=2,
+                  predictor="mhcflurry-predict", models_dir=None, chunk_dir=None):
+    if backend == "cli":
+        return run_pairs(pairs, output_location, chunk_size, processes, retries, predictor, chunk_dir)
+    return score_pairs(pairs, output_location, backend, chunk_size, models_dir)
+
+
+# Method: predict_grid
+# Goal: Predict every allele x peptide pair with selected backend
+# Input:
+#   peptides: iterable of unique peptides
+#   alleles: list of alleles
+#   output_location: Location of predictions csv
+#   backend, processes, retries, predictor, models_dir, chunk_dir: As in predict_pairs
+#   chunk_size: Peptides per work unit or batch
+# Output: Location of predictions csv
+def predict_grid(peptides, alleles, output_location, backend="cli", chunk_size=5000, processes=1, retries=2,
+                 predictor="mhcflurry-predict", models_dir=None, chunk_dir=None):
+    if backend == "cli":
+        return run_chunked(peptides, alleles, output_location, chunk_size, processes, retries, predictor,
+                           chunk_dir)
+    # Allele-major so every batch shares one allele
+    peptides = list(peptides)
+    pairs = ((allele, peptide) for allele in dict.fromkeys(alleles) for peptide in peptides)
+    return score_pairs(pairs, output_location, backend, chunk_size, models_dir)
+
+
+# Method: models_version
+# Goal: Identify MHCFlurry models in use - hash of models manifest, so downloading new models changes it
+# Input: models_dir: Directory of MHCFlurry models, None for MHCFlurry default download location
+# Output: Version string, "unknown" when MHCFlurry or its models cannot be found
+def models_version(models_dir=None):
+    if models_dir is None:
+        try:
+            from mhcflurry.downloads import get_default_class1_models_dir
+            models_dir = get_default_class1_models_dir()
+        except Exception:  # MHCFlurry not installed here, or no models downloaded
+            return "unknown"
+    manifest = os.path.join(models_dir, "manifest.csv")
+    if not os.path.exists(manifest):
+        return "unknown"
+    return hash_file(manifest)[:16]
+
+
+# Method: backend_version
+# Goal: Default cache version key for a backend - backend, installed MHCFlurry release and models,
+#   so predictions made before an MHCFlurry or model upgrade are not served after it
+# Output: Version key string
+def backend_version(backend, predictor="mhcflurry-predict", models_dir=None):
+    if backend == "fake":
+        return backend
+    try:
+        release = importlib.metadata.version("mhcflurry")
+    except importlib.metadata.PackageNotFoundError:
+        release = "unknown"
+    if backend == "cli":
+        return "cli:" + predictor + ":" + release + ":" + models_version()
+    return "inprocess:" + release + ":" + models_version(models_dir)
+
+
+# Method: predict_frame
+# Goal: Score peptides against alleles directly into a DataFrame, no files involved
+# Input:
+#   peptides: List of peptides
+#   alleles: List of alleles
+#   backend: "inprocess", "fake" or "cli"
+#   batch_size: Maximum peptides scored at once
+#   models_dir: Directory of MHCFlurry models
+#   predictor: Predictor executable for cli backend
+# Output: DataFrame with allele, peptide, mhcflurry_affinity, mhcflurry_affinity_percentile
+def predict_frame(peptides, alleles, backend="inprocess", batch_size=5000, models_dir=None,
+                  predictor="mhcflurry-predict"):
+    if backend == "cli":
+        # CLI backend has to go through a file
+        tmp_fd, tmp_location = tempfile.mkstemp(prefix="mhcflurry_frame_", suffix=".csv")
+        os.close(tmp_fd)
+        try:
+            run_chunked(peptides, alleles, tmp_location, batch_size, predictor=predictor)
+            return pd.read_csv(tmp_location)
+        finally:
+            os.remove(tmp_location)
+    scorer = scorers[backend]
+    frames = []
+    for allele in dict.fromkeys(alleles):
+        for start in range(0, len(peptides), batch_size):
+            batch = peptides[start:start + batch_size]
+            affinities, percentiles = scorer(allele, batch, models_dir)
+            frames.append(pd.DataFrame({"allele": allele, "peptide": batch, "mhcflurry_affinity": affinities,
+                                        "mhcflurry_affinity_percentile": percentiles}))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["allele", "peptide", "mhcflurry_affinity", "mhcflurry_affinity_percentile"])
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,152 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import contextlib
+import cProfile
+import json
+import resource
+import sys
+import time
+
+# GLOBAL #
+# Report of current run, None while instrumentation is off - stage() and count() then cost one check
+active = None
+
+# Shared do-nothing context manager handed out by stage() while instrumentation is off
+no_stage = contextlib.nullcontext()
+
+
+# Method: usage
+# Goal: Clock, CPU time and peak RSS of this process and of finished child processes (ex. mhcflurry-predict)
+# Output: Dictionary of wall, cpu, child_cpu (seconds), peak_rss_mb, child_peak_rss_mb
+#   Peak RSS is the high-water mark of the whole process so far (of the daemon's lifetime inside mhc_daemon)
+def usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"wall": time.perf_counter(), "cpu": own.ru_utime + own.ru_stime,
+            "child_cpu": children.ru_utime + children.ru_stime, "peak_rss_mb": own.ru_maxrss / 1024,
+            "child_peak_rss_mb": children.ru_maxrss / 1024}
+
+
+# Method: emit
+# Goal: Write event line to NDJSON report as it happens, a crashed run still leaves finished stages behind
+def emit(event):
+    if active["stream"] is not None:
+        active["stream"].write(json.dumps(event) + "\n")
+        active["stream"].flush()
+
+
+# Method: start_report
+# Goal: Turn instrumentation on for a run, nothing is recorded unless a report or profile is requested
+# Input:
+#   script: Script name
+#   argv: Command line arguments of run
+#   report_location: JSON report (.ndjson for one event per line, written as stages finish), None for none
+#   profile_location: cProfile dump, None for no profiling
+def start_report(script, argv, report_location=None, profile_location=None):
+    global active
+    active = None
+    if report_location is None and profile_location is None:
+        return
+    active = {"location": report_location, "profile_location": profile_location, "stages": [], "counts": {},
+              "current": None, "start": usage(),
+              "run": {"script": script, "argv": list(argv), "started": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "stream": None, "profiler": None}
+    if report_location is not None and report_location.endswith(".ndjson"):
+        active["stream"] = open(report_location, "w")
+        emit(dict(active["run"], event="start"))
+    if profile_location is not None:
+        active["profiler"] = cProfile.Profile()
+        active["profiler"].enable()
+
+
+# Method: stage
+# Goal: Context manager timing a pipeline stage, ex. with stage("predict"): ...
+# Input: Stage name
+def stage(name):
+    if active is None:
+        return no_stage
+    return timed_stage(name)
+
+
+# Method: timed_stage
+# Goal: Record wall/CPU time, memory and counts made inside a stage
+#   process_peak_rss_mb is the process high-water mark at stage end, peak_rss_growth_mb how far this stage raised it
+@contextlib.contextmanager
+def timed_stage(name):
+    before = usage()
+    outer_counts = active["current"]
+    active["current"] = {}
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        after = usage()
+        record = {"event": "stage", "stage": name, "status": status,
+                  "wall": round(after["wall"] - before["wall"], 6), "cpu": round(after["cpu"] - before["cpu"], 6),
+                  "child_cpu": round(after["child_cpu"] - before["child_cpu"], 6),
+                  "process_peak_rss_mb": round(after["peak_rss_mb"], 1),
+                  "peak_rss_growth_mb": round(after["peak_rss_mb"] - before["peak_rss_mb"], 1),
+                  "child_process_peak_rss_mb": round(after["child_peak_rss_mb"], 1), "counts": active["current"]}
+        active["current"] = outer_counts
+        active["stages"].append(record)
+        emit(record)
+
+
+# Method: count
+# Goal: Add to a named count of run and of the stage running, ex. count("fragments", 5422)
+def count(name, value):
+    if active is None:
+        return
+    active["counts"][name] = active["counts"].get(name, 0) + value
+    if active["current"] is not None:
+        active["current"][name] = active["current"].get(name, 0) + value
+
+
+# Method: finish_report
+# Goal: Write run report and profile, then turn instrumentation off
+# Input: status: Outcome of run, ok or failed
+# Output: Run totals as written, None when instrumentation was off
+def finish_report(status="ok"):
+    global active
+    if active is None:
+        return None
+    report = active
+    active = None
+    if report["profiler"] is not None:
+        report["profiler"].disable()
+        report["profiler"].dump_stats(report["profile_location"])
+    end = usage()
+    counts = report["counts"]
+    totals = dict(report["run"], event="finish", status=status, wall=round(end["wall"] - report["start"]["wall"], 6),
+                  cpu=round(end["cpu"] - report["start"]["cpu"], 6),
+                  child_cpu=round(end["child_cpu"] - report["start"]["child_cpu"], 6),
+                  process_peak_rss_mb=round(end["peak_rss_mb"], 1),
+                  peak_rss_growth_mb=round(end["peak_rss_mb"] - report["start"]["peak_rss_mb"], 1),
+                  child_process_peak_rss_mb=round(end["child_peak_rss_mb"], 1), counts=counts)
+    if counts.get("cache_hits", 0) + counts.get("cache_misses", 0) > 0:
+        totals["cache_hit_rate"] = round(counts["cache_hits"] / (counts["cache_hits"] + counts["cache_misses"]), 4)
+    if report["stream"] is not None:
+        report["stream"].write(json.dumps(totals) + "\n")
+        report["stream"].close()
+    elif report["location"] is not None:
+        with open(report["location"], "w") as f:
+            json.dump(dict(totals, stages=report["stages"]), f, indent=1)
+    return totals
+
+
+# Method: run_report
+# Goal: Context manager around a whole run, report is written with status failed if the run raises
+# Input: As in start_report, argv None for sys.argv
+@contextlib.contextmanager
+def run_report(script, argv=None, report_location=None, profile_location=None):
+    start_report(script, sys.argv[1:] if argv is None else argv, report_location, profile_location)
+    try:
+        yield
+    except BaseException:
+        finish_report("failed")
+        raise
+    finish_report()
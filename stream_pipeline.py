@@ -0,0 +1,297 @@
+# Author: Austin Seamann
+# Version: 1.0
+# Last Updated: December 10th, 2021
+import argparse
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import mhc_analysis
+from allele_registry import grab_mhc, load_supported
+from fragment_to_infinity import hla_file_list, select_alleles, stream_fragment_keys, stream_seq
+from mhc_analysis import allele_id_counts, binders, box_plot, box_plot_freq, histogram, plot_location, \
+    process_file, scatter_freq, weighted_scores
+from peptide_codec import decode_keys
+from predictors import backends, predict_frame
+from run_report import count, run_report, stage
+
+# GLOBAL #
+done = None  # Placed on a queue once per consumer when producer side is finished
+poll_interval = 0.1  # Seconds a blocked put/get waits before checking whether the run was stopped
+
+
+# Method: put_until
+# Goal: Put item on bounded queue, giving up once stop is set so a failed run leaves no thread blocked
+# Output: True if item was put, False if run was stopped
+def put_until(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=poll_interval)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# Method: get_until
+# Goal: Get item from queue, done once stop is set
+def get_until(items, stop):
+    while not stop.is_set():
+        try:
+            return items.get(timeout=poll_interval)
+        except queue.Empty:
+            pass
+    return done
+
+
+# Method: produce_batches
+# Goal: Fragment proteins as they are read and hand out batches of peptides not seen before
+#   Put blocks once queue is full, so fragmentation never runs far ahead of prediction
+# Input:
+#   fasta: Protein sequence FASTA file (.gz accepted)
+#   sizes: List of fragment sizes
+#   batch_size: Unique peptides per batch
+#   batches: Queue of (batch number, int64 keys), bounded
+#   workers: Number of prediction workers, each gets a done marker, also when fragmenting fails
+#   stats: Dictionary, fragments and unique_peptides counts filled in
+#   stop: threading.Event set when run is abandoned
+def produce_batches(fasta, sizes, batch_size, batches, workers, stats, stop):
+    seen = set()  # Every key handed out, batches never overlap
+    pending = []
+    batch_number = 0
+    try:
+        for current_id, keys, positions in stream_fragment_keys(stream_seq(fasta), sizes):
+            stats["fragments"] += len(keys)
+            for key in np.unique(keys).tolist():
+                if key not in seen:
+                    seen.add(key)
+                    pending.append(key)
+            while len(pending) >= batch_size:
+                if not put_until(batches, (batch_number, np.array(pending[:batch_size], dtype=np.int64)), stop):
+                    return
+                pending = pending[batch_size:]
+                batch_number += 1
+        if len(pending) > 0:
+            put_until(batches, (batch_number, np.array(pending, dtype=np.int64)), stop)
+        stats["unique_peptides"] = len(seen)
+    finally:
+        for worker in range(workers):
+            put_until(batches, done, stop)
+
+
+# Method: predict_batches
+# Goal: Prediction worker - predict every allele x peptide pair of each batch and pass frame on
+# Input:
+#   batches: Queue filled by produce_batches
+#   results: Queue of (batch number, predictions DataFrame), bounded
+#   alleles: List of alleles to submit, ex. HLA-A*02:01
+#   backend, predictor, models_dir: As in predictors.predict_frame
+#   stop: threading.Event set when run is abandoned
+def predict_batches(batches, results, alleles, backend, predictor, models_dir, stop):
+    while True:
+        batch = get_until(batches, stop)
+        if batch is done:
+            return
+        batch_number, keys = batch
+        peptides = decode_keys(keys)
+        predictions = predict_frame(peptides, alleles, backend, len(peptides), models_dir, predictor)
+        if not put_until(results, (batch_number, predictions), stop):
+            return
+
+
+# Method: guarded
+# Goal: Run pipeline thread, then hand consumer its outcome - done, or the exception instead of dying silently
+#   Consumer waits for one outcome per thread, so an exception cannot be overtaken by done markers
+def guarded(target, results, stop, *args):
+    try:
+        target(*args, stop)
+        outcome = done
+    except BaseException as error:
+        outcome = error
+    put_until(results, outcome, stop)
+
+
+# Method: combine_counts
+# Goal: Add up per batch allele_id_counts - batches hold disjoint peptides, so unique counts simply sum
+# Input: List of DataFrames from mhc_analysis.allele_id_counts
+# Output: DataFrame as from allele_id_counts over every batch
+def combine_counts(count_parts):
+    if len(count_parts) == 0:
+        return pd.DataFrame({"count": pd.Series(dtype=np.int64), "freq": pd.Series(dtype=float),
+                             "Population": pd.Series(dtype=str)}, index=pd.Index([], name="Allele_ID", dtype=str))
+    counts = pd.concat(count_parts)
+    return counts.groupby(level=0, sort=True).agg(count=("count", "sum"), freq=("freq", "first"),
+                                                  Population=("Population", "first"))
+
+
+# Method: run_streaming
+# Goal: Fragmentation, prediction and aggregation running at once - fragment batches flow into prediction
+#   workers through bounded queues, predictions flow straight into population/frequency aggregation.
+#   Only binding rows are held, results are ready when the last batch lands
+# Input:
+#   fasta: Protein sequence FASTA file (.gz accepted)
+#   sizes: List of fragment sizes (internal sizes, as given to stream_fragment_keys)
+#   alleles: List of alleles to submit, from select_alleles
+#   hlas_inverse: Allele:Population List
+#   hlas_freq: Allele:{Population:freq}
+#   affinity: Affinity cutoff in nM for binders
+#   batch_size: Unique peptides per batch
+#   workers: Number of prediction workers
+#   queue_size: Batches allowed to wait in each queue
+#   backend, predictor, models_dir: As in predictors.predict_frame
+#   output_location: Predictions csv written as batches land in batch order, None to keep nothing on disk
+# Output: Dictionary holding
+#   binders: DataFrame of binding rows with population columns, as from mhc_analysis.binders
+#   scores: DataFrame from mhc_analysis.weighted_scores
+#   fragments, unique_peptides, predictions, batches: Counts
+def run_streaming(fasta, sizes, alleles, hlas_inverse, hlas_freq, affinity=500, batch_size=5000, workers=1,
+                  queue_size=4, backend="cli", predictor="mhcflurry-predict", models_dir=None,
+                  output_location=None):
+    batches = queue.Queue(maxsize=queue_size)
+    results = queue.Queue(maxsize=queue_size)
+    stream = {"fragments": 0, "unique_peptides": 0, "predictions": 0, "batches": 0}
+    # Set when the consumer stops early, every blocked put/get then gives up and its thread ends
+    stop = threading.Event()
+    threads = [threading.Thread(target=guarded, args=(produce_batches, results, stop, fasta, sizes, batch_size,
+                                                      batches, workers, stream), daemon=True)]
+    for worker in range(workers):
+        threads.append(threading.Thread(target=guarded, args=(predict_batches, results, stop, batches, results,
+                                                              alleles, backend, predictor, models_dir), daemon=True))
+    for thread in threads:
+        thread.start()
+    binder_parts = []
+    count_parts = []
+    waiting = {}  # Batch number:predictions that landed ahead of an earlier batch
+    next_batch = 0
+    finished = 0
+    try:
+        while finished < len(threads):
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            if result is done:
+                finished += 1
+                continue
+            waiting[result[0]] = result[1]
+            # Aggregate in batch order, output and results do not depend on worker timing
+            while next_batch in waiting:
+                predictions = waiting.pop(next_batch)
+                if output_location is not None:
+                    predictions.to_csv(output_location, mode="w" if next_batch == 0 else "a",
+                                       header=next_batch == 0, index=False)
+                binder_df = binders(process_file(predictions, hlas_inverse, hlas_freq), affinity)
+                binder_parts.append(binder_df)
+                count_parts.append(allele_id_counts(binder_df))
+                stream["predictions"] += len(predictions)
+                next_batch += 1
+    finally:
+        stop.set()
+    for thread in threads:
+        thread.join()
+    stream["batches"] = next_batch
+    if len(binder_parts) == 0:
+        empty = pd.DataFrame(columns=["allele", "peptide", "mhcflurry_affinity", "mhcflurry_affinity_percentile"])
+        if output_location is not None:
+            empty.to_csv(output_location, index=False)  # Header only
+        binder_parts.append(binders(process_file(empty, hlas_inverse, hlas_freq), affinity))
+    binder_df = pd.concat(binder_parts, ignore_index=True)
+    stream["binders"] = binder_df
+    stream["scores"] = weighted_scores(combine_counts(count_parts))
+    return stream
+
+
+# Method: parse_args
+# Goal: Collect command line arguments from user
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fasta", help="Fasta file in containing protein sequences (.gz accepted)", type=str)
+    parser.add_argument("-s", "--size", help="Sizes of fragment, several may be given", type=int, nargs="+",
+                        required=True)
+    parser.add_argument("-a", help="HLA-A XLSX file from Be The Match", type=str)
+    parser.add_argument("-b", help="HLA-B XLSX file from Be The Match", type=str)
+    parser.add_argument("-c", help="HLA-C XLSX file from Be The Match", type=str)
+    parser.add_argument("-o", "--out", help="Also write MHCflurry predictions csv as batches land", type=str)
+    parser.add_argument("--summary", help="Save weighted binder scores as csv", type=str)
+    parser.add_argument("--backend", help="Predictor backend", type=str, choices=backends, default="cli")
+    parser.add_argument("--predictor", help="MHCflurry predict executable", type=str, default="mhcflurry-predict")
+    parser.add_argument("--models_dir", help="MHCflurry models directory for inprocess backend", type=str)
+    parser.add_argument("--batch_size", help="Unique peptides per batch", type=int, default=5000)
+    parser.add_argument("-w", "--workers", help="Number of prediction workers", type=int, default=1)
+    parser.add_argument("--queue_size", help="Batches allowed to wait between stages", type=int, default=4)
+    parser.add_argument("--code", help="Change from Broad_race codes to Race codes", action="store_true",
+                        default=False)
+    parser.add_argument("--save", help="Save plot", type=str, default="...")
+    parser.add_argument("--width", help="Width of plot area, if saved", type=float, default=11)
+    parser.add_argument("--height", help="Height of plot area, if saved", type=float, default=8.5)
+    parser.add_argument("--box", help="Box plot of prediction percentile vs population", action="store_true",
+                        default=False)
+    parser.add_argument("--histo", help="Histogram plot of count of 90 percentile vs population", action="store_true",
+                        default=False)
+    parser.add_argument("--scatterF", help="Scatter plot of weighted HLA binder scores", action="store_true",
+                        default=False)
+    parser.add_argument("--boxF", help="Box plot of weighted HLA binder scores", action="store_true",
+                        default=False)
+    parser.add_argument("--affinity", help="Affinity cutoff (nM) for binders", type=float, default=500)
+    parser.add_argument("--report", help="Per-stage run report, JSON (.ndjson for one line per stage)", type=str)
+    parser.add_argument("--profile", help="cProfile dump of run", type=str)
+    return parser.parse_args(argv)
+
+
+# Method: run
+# Goal: Run streaming pipeline for parsed command line arguments
+def run(args):
+    mhc_analysis.code_used = mhc_analysis.codes["Race"] if args.code else mhc_analysis.codes["Broad_race"]
+    with stage("grab_mhc"):
+        hla_files = hla_file_list(args)
+        # Alleles submitted as in fragment_to_infinity (rank 50), populations analysed as in mhc_analysis (rank 25)
+        hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files, 50.0)
+        alleles, unsupported_alleles = select_alleles(hlas, load_supported())
+        hlas, hlas_inverse, hlas_freq = grab_mhc(hla_files, 25.0)
+    print("Running streaming pipeline...")
+    # Fragmenting, prediction and aggregation overlap, so they are one stage
+    with stage("stream"):
+        stream = run_streaming(args.fasta, [size + 1 for size in args.size], alleles, hlas_inverse, hlas_freq,
+                               args.affinity, args.batch_size, args.workers, args.queue_size, args.backend,
+                               args.predictor, args.models_dir, args.out)
+        for name in ["fragments", "unique_peptides", "predictions", "batches"]:
+            count(name, stream[name])
+        count("binders", len(stream["binders"]))
+    print("Fragments: " + str(stream["fragments"]) + " Unique peptides: " + str(stream["unique_peptides"])
+          + " Predictions: " + str(stream["predictions"]) + " Batches: " + str(stream["batches"]))
+    print(stream["scores"].groupby("Population")["Weighted_Value"].sum().to_string())
+    if args.summary:
+        stream["scores"].to_csv(args.summary, index=False)
+        print("Summary: " + args.summary)
+    if args.out:
+        print("Results: " + args.out)
+    plots = [plot_name for plot_name in ["box", "histo", "scatterF", "boxF"] if getattr(args, plot_name)]
+    several = len(plots) > 1
+    if args.box:
+        with stage("plot_box"):
+            box_plot(stream["binders"], plot_location(args.save, "box", several), args.width, args.height)
+    if args.histo:
+        with stage("plot_histo"):
+            histogram(stream["binders"], plot_location(args.save, "histo", several), args.width, args.height,
+                      args.affinity)
+    if args.scatterF:
+        with stage("plot_scatterF"):
+            scatter_freq(stream["scores"], plot_location(args.save, "scatterF", several), args.width, args.height,
+                         args.affinity)
+    if args.boxF:
+        with stage("plot_boxF"):
+            box_plot_freq(stream["scores"], plot_location(args.save, "boxF", several), args.width, args.height,
+                          args.affinity)
+    print("Done!")
+
+
+# Method: main
+# Goal: Control the operation of program
+# Input: Command line arguments, None for sys.argv (daemon passes client arguments)
+def main(argv=None):
+    args = parse_args(argv)
+    with run_report("stream_pipeline", argv, args.report, args.profile):
+        run(args)
+
+
+if __name__ == "__main__":
+    main()